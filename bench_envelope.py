@@ -0,0 +1,70 @@
+"""
+Microbenchmark: JSON vs binary envelope for inter-server pub/sub payloads.
+
+Measures, per message, the publisher's encode cost, each receiving server's
+decode cost, and the bytes Redis moves: the PUBLISH command in, plus one
+"message" push out per subscribed server (RESP framing included).
+
+    python bench_envelope.py [CONTENT_LENGTH] [SUBSCRIBED_SERVERS]
+"""
+import json
+import sys
+import time
+import timeit
+
+from envelope import decode_payload, encode_envelope
+
+def json_payload(msg_type, sender, content, room, ts):
+    # Same shape as server.chat_payload with PUBSUB_ENCODING=json
+    return json.dumps({"type": msg_type, "sender": sender, "content": content, "room": room, "ts": ts})
+
+def resp_bulk(data):
+    return len(f"${len(data)}\r\n") + len(data) + 2
+
+def redis_bytes(channel, payload, servers):
+    channel = channel.encode()
+    payload = payload.encode() if isinstance(payload, str) else payload
+    publish = len("*3\r\n") + resp_bulk(b"PUBLISH") + resp_bulk(channel) + resp_bulk(payload)
+    push = len("*3\r\n") + resp_bulk(b"message") + resp_bulk(channel) + resp_bulk(payload)
+    return publish + push * servers
+
+def per_call_us(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+if __name__ == "__main__":
+    content_length = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    servers = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    sender, room = "alice", "general"
+    content = f"[{room}] {sender}: " + "x" * content_length
+    ts = time.time()
+    number = 50000
+
+    # Receivers get bytes from Redis and forward UTF-8 bytes to clients
+    json_raw = json_payload("BROADCAST", sender, content, room, ts).encode()
+    binary_raw = encode_envelope("BROADCAST", sender, content, room, ts=ts)
+
+    results = {
+        "json": {
+            "encode_us": per_call_us(lambda: json_payload("BROADCAST", sender, content, room, ts), number),
+            "decode_us": per_call_us(lambda: decode_payload(json_raw)["content"].encode(), number),
+            "payload_bytes": len(json_raw),
+            "redis_bytes": redis_bytes(f"room:{room}", json_raw, servers),
+        },
+        "binary": {
+            "encode_us": per_call_us(lambda: encode_envelope("BROADCAST", sender, content, room, ts=ts), number),
+            "decode_us": per_call_us(lambda: decode_payload(binary_raw)["content"], number),
+            "payload_bytes": len(binary_raw),
+            "redis_bytes": redis_bytes(f"room:{room}", binary_raw, servers),
+        },
+    }
+
+    print(f"Content of {len(content)} chars, {servers} subscribed servers "
+          f"(decode includes getting the content as UTF-8 bytes)\n")
+    print(f"{'format':<8}{'encode us':>11}{'decode us':>11}{'payload B':>11}{'Redis B/msg':>13}")
+    for name, row in results.items():
+        print(f"{name:<8}{row['encode_us']:>11.2f}{row['decode_us']:>11.2f}"
+              f"{row['payload_bytes']:>11}{row['redis_bytes']:>13}")
+    cluster_decode = {name: row["decode_us"] * servers for name, row in results.items()}
+    print(f"\nDecode CPU across the cluster per message: json {cluster_decode['json']:.0f} us, "
+          f"binary {cluster_decode['binary']:.0f} us")
@@ -0,0 +1,130 @@
+"""
+Fan-out benchmark for one busy room.
+
+Pushes chat messages for a room of ROOM_SIZE local members through the
+server's relay path and counts, per message:
+
+  - bytes encoded (str -> bytes work done by the server)
+  - socket writes (each sendall on a TLS socket is at least one TLS record
+    and one write syscall)
+
+"before" is the old path: JSON pub/sub payloads, content re-encoded for
+every recipient and one sendall per message. "after" is
+server.handle_chat_message with the pub/sub encoding the server picked: the
+message is encoded once and shared, and for framed clients each writer
+sends whatever queued up within OUTBOUND_FLUSH_DELAY in a single write.
+Text-mode clients get one write per message: their lines are
+newline-delimited, but older text clients take each read as one message.
+BURST is how many messages reach a socket within one flush window.
+
+Sockets are replaced by counters. Importing server.py opens the state
+backend, so run with STATE_BACKEND=memory, or with a Redis server at
+REDIS_HOST/REDIS_PORT.
+
+    STATE_BACKEND=memory python bench_fanout.py [ROOM_SIZE] [MESSAGES] [BURST]
+"""
+import sys
+
+import server
+from protocol import encode_frame
+
+class CountingSocket:
+    """Stands in for a client socket and counts writes."""
+
+    def __init__(self):
+        self.writes = 0
+        self.bytes_sent = 0
+
+    def sendall(self, data):
+        self.writes += 1
+        self.bytes_sent += len(data)
+
+def make_room(room_size, framed):
+    sockets = [CountingSocket() for _ in range(room_size)]
+    for i, sock in enumerate(sockets):
+        server.local.clients[sock] = f"user{i}"
+        server.local.rooms.setdefault("lobby", set()).add(sock)
+        server.outbound_queues[sock] = server.OutboundQueue(limit=1_000_000)
+        if framed:
+            server.local.decoders[sock] = None
+    return sockets
+
+def reset_room():
+    for registry in (server.local.clients, server.local.rooms,
+                     server.outbound_queues, server.local.decoders):
+        registry.clear()
+
+def messages(count):
+    for i in range(count):
+        content = f"[sender] message number {i} with some typical chat text"
+        yield server.chat_payload("BROADCAST", "sender", content, "lobby")
+
+def run_before(room_size, count, framed):
+    """Old relay: encode per recipient, one sendall per message."""
+    sockets = make_room(room_size, framed)
+    encoded = 0
+    publish_binary = server.publish_binary
+    server.publish_binary = False   # the old path predates binary envelopes
+    try:
+        for payload in messages(count):
+            data = server.decode_payload(payload)
+            for sock in sockets:
+                wire = data["content"].encode()
+                encoded += len(wire)
+                if framed:
+                    wire = encode_frame(wire)
+                sock.sendall(wire)
+    finally:
+        server.publish_binary = publish_binary
+    reset_room()
+    return sockets, encoded
+
+def run_after(room_size, count, burst, framed):
+    """Current relay: encode once, writers flush each burst in one write."""
+    sockets = make_room(room_size, framed)
+    encoded = 0
+    encode_outbound = server.encode_outbound
+
+    def counting_encode(text):
+        nonlocal encoded
+        wire = encode_outbound(text)
+        encoded += len(wire[0]) + len(wire[1])
+        return wire
+
+    server.encode_outbound = counting_encode
+    try:
+        for i, payload in enumerate(messages(count), 1):
+            server.handle_chat_message(server.local, server.decode_payload(payload))
+            if i % burst == 0 or i == count:
+                # What each connection_writer does once the flush window closes
+                for sock in sockets:
+                    batch = server.outbound_queues[sock].take_all()
+                    if framed:
+                        sock.sendall(b"".join(batch))
+                    else:
+                        for data in batch:
+                            sock.sendall(data)
+    finally:
+        server.encode_outbound = encode_outbound
+    reset_room()
+    return sockets, encoded
+
+def report(label, sockets, encoded, count):
+    writes = sum(s.writes for s in sockets)
+    sent = sum(s.bytes_sent for s in sockets)
+    print(f"{label:<26} encoded/msg={encoded / count:>8.0f} B   "
+          f"writes/msg={writes / count:>7.1f}   sent/msg={sent / count:>7.0f} B")
+
+if __name__ == "__main__":
+    room_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    burst = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+    encoding = "binary" if server.publish_binary else "JSON"
+    print(f"Room of {room_size} members, {count} messages, burst of {burst} per flush window, "
+          f"{encoding} pub/sub payloads after\n")
+    for framed in (False, True):
+        mode = "framed" if framed else "text"
+        report(f"before ({mode})", *run_before(room_size, count, framed), count)
+        report(f"after ({mode}, burst=1)", *run_after(room_size, count, 1, framed), count)
+        report(f"after ({mode}, burst={burst})", *run_after(room_size, count, burst, framed), count)
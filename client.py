@@ -3,99 +3,263 @@ import threading
 import ssl
 import sys
 import os
+import time
+import random
+from collections import deque
+from protocol import (FRAMED_MAGIC, FRAME_PING, FRAME_PONG, FRAME_TEXT, LINE_END, PING_LINE, PONG_LINE,
+                      FrameDecoder, encode_frame, encode_frames)
+from resume_tokens import find_token
 
 # Default Config
 DEFAULT_HOST = '127.0.0.1'
 DEFAULT_PORT = 8000
+AUTH_BUSY_RETRIES = 5   # reconnect attempts when the server's auth queue is full
+RECONNECT_ATTEMPTS = 5  # automatic reconnects after the connection drops
 
-def receive_messages(client_socket):
+# Last TLS session per (host, port, username). Reconnects offer it so the
+# server can resume instead of running a full handshake.
+tls_sessions = {}
+
+# The receive thread answers pings while the input thread sends
+send_lock = threading.Lock()
+
+# Text-mode messages received but not yet returned: {socket: deque of lines}
+text_pending = {}
+
+def send_lines(client_socket, lines, decoder):
+    """Sends commands/messages. In framed mode they are pipelined in one write."""
+    with send_lock:
+        if decoder is not None:
+            client_socket.sendall(encode_frames([line.encode() for line in lines]))
+        else:
+            for line in lines:
+                client_socket.send(line.encode())
+
+def send_pong(client_socket, decoder):
+    if decoder is None:
+        send_lines(client_socket, [PONG_LINE], None)
+    else:
+        with send_lock:
+            client_socket.sendall(encode_frame(b"", FRAME_PONG))
+
+def read_text_message(client_socket):
+    """Text mode: one read can hold several newline-terminated messages
+    (a PING or FORCED_LOGOUT glued to a chat line). They are returned one
+    at a time. An unterminated read is one message, as older servers send."""
+    pending = text_pending.setdefault(client_socket, deque())
+    while not pending:
+        data = client_socket.recv(1024)
+        if not data:
+            text_pending.pop(client_socket, None)
+            return ''
+        pending.extend(line.decode('utf-8') for line in data.split(LINE_END) if line)
+    return pending.popleft()
+
+def read_message(client_socket, decoder):
+    """Returns the next server message, or '' once the connection is closed.
+    A ping frame is returned as PING_LINE, as text-mode servers send it."""
+    if decoder is None:
+        return read_text_message(client_socket)
     while True:
-        try:
-            message = client_socket.recv(1024).decode('utf-8')
-            if not message:
-                break
-            
-            if message.startswith("FORCED_LOGOUT"):
-                print(f"\n[SYSTEM] {message}")
-                client_socket.close()
-                os._exit(0) # Force exit immediately
-            
-            print(f"\n{message}")
-        except:
-            print("\n[SYSTEM] Disconnected from server.")
-            os._exit(0)
+        for frame_type, payload in decoder.frames():
+            if frame_type == FRAME_TEXT:
+                return str(payload, 'utf-8')
+            if frame_type == FRAME_PING:
+                return PING_LINE
+        if decoder.recv_from(client_socket) == 0:
+            return ''
 
-def start_client(host, port):
+def authenticate(client_socket, decoder, choice, username, password):
+    """
+    Runs REGISTER (optional) and LOGIN, or RESUME when choice is 'resume'
+    (password is then the resume token). Returns the last server response,
+    or '' if the server closed the connection without answering.
+    """
+    login_line = f"RESUME {password}" if choice == 'resume' else f"LOGIN {username} {password}"
+    try:
+        if decoder is not None:
+            # Framed: magic + REGISTER + LOGIN go out in a single write
+            lines = [login_line]
+            if choice == 'register':
+                lines.insert(0, f"REGISTER {username} {password}")
+            client_socket.sendall(FRAMED_MAGIC + encode_frames([line.encode() for line in lines]))
+            response = read_message(client_socket, decoder)
+            if choice == 'register' and response.startswith("REGISTER_SUCCESS"):
+                print("Registration successful! Now logging you in...")
+                response = read_message(client_socket, decoder)
+            return response
+
+        if choice == 'register':
+            client_socket.send(f"REGISTER {username} {password}".encode())
+            response = read_text_message(client_socket)
+            if not response.startswith("REGISTER_SUCCESS"):
+                return response
+            print("Registration successful! Now logging you in...")
+            # After successful registration, server waits for login
+        client_socket.send(login_line.encode())
+        # Messages after the reply (join notices, history) stay queued
+        return read_text_message(client_socket)
+    except OSError:
+        return ''
+
+def create_ssl_context():
     # Create an SSL context that REQUIRES verification
     context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
     
     # Load the server's public certificate (Pinning)
     # The client must have the 'server.crt' file in the same folder
-    try:
-        context.load_verify_locations('server.crt')
-    except FileNotFoundError:
-        print("Error: 'server.crt' not found. Cannot verify server.")
-        return
+    context.load_verify_locations('server.crt')
 
     # Enforce verification
     context.verify_mode = ssl.CERT_REQUIRED
     context.check_hostname = True
+    return context
 
+def open_connection(context, host, port, session=None):
     raw_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    print(f"Connecting to {host}:{port} securely...")
+    client_socket = context.wrap_socket(raw_socket, server_hostname=host, session=session)
+    client_socket.connect((host, port))
+    return client_socket
+
+def login(context, host, port, choice, username, password):
+    """
+    Connects and authenticates, preferring the framed protocol. A server that
+    does not speak it closes the connection, and we retry in text mode.
+    AUTH_BUSY replies are retried with jittered exponential backoff.
+    Returns (socket, decoder, response); decoder is None in text mode.
+    """
+    session_key = (host, port, username)
+    for attempt in range(AUTH_BUSY_RETRIES + 1):
+        for framed in (True, False):
+            client_socket = open_connection(context, host, port, tls_sessions.get(session_key))
+            decoder = FrameDecoder() if framed else None
+            response = authenticate(client_socket, decoder, choice, username, password)
+            if response:
+                # TLS 1.3 tickets arrive after the handshake; by the time
+                # the server has answered, the session is resumable.
+                tls_sessions[session_key] = client_socket.session
+            if response or not framed:
+                break
+            client_socket.close()
+
+        if not response.startswith("AUTH_BUSY") or attempt == AUTH_BUSY_RETRIES:
+            return client_socket, decoder, response
+        client_socket.close()
+        delay = min(2 ** attempt, 10) * random.uniform(0.5, 1.0)
+        print(f"Server busy, retrying in {delay:.1f}s...")
+        time.sleep(delay)
+
+def reconnect(session, context, host, port, username, password):
+    """
+    Re-establishes a dropped connection, preferring RESUME with the last
+    token (no bcrypt on the server) and falling back to the password.
+    Updates session in place. Returns True once logged in again.
+    """
+    session["socket"].close()
+    text_pending.pop(session["socket"], None)
+    for attempt in range(RECONNECT_ATTEMPTS):
+        time.sleep(min(2 ** attempt, 10) * random.uniform(0.5, 1.0))
+        if session["closing"]:
+            return False
+        try:
+            response = ''
+            if session["token"]:
+                client_socket, decoder, response = login(context, host, port, 'resume', username, session["token"])
+                if not response.startswith("AUTH_SUCCESS"):
+                    client_socket.close()
+                    session["token"] = None
+            if not response.startswith("AUTH_SUCCESS"):
+                client_socket, decoder, response = login(context, host, port, 'login', username, password)
+        except OSError:
+            continue
+        if response.startswith("AUTH_SUCCESS"):
+            session.update(socket=client_socket, decoder=decoder, token=find_token(response, username))
+            return True
+        client_socket.close()
+        if response.startswith("AUTH_FAILED"):
+            return False
+    return False
+
+def receive_messages(session, reconnect_fn):
+    while True:
+        try:
+            message = read_message(session["socket"], session["decoder"])
+        except Exception:
+            message = ''
+        if not message:
+            if session["closing"]:
+                return
+            print("\n[SYSTEM] Connection lost, reconnecting...")
+            if reconnect_fn():
+                print("[SYSTEM] Reconnected.")
+                continue
+            print("\n[SYSTEM] Disconnected from server.")
+            os._exit(0)
+
+        if message == PING_LINE:
+            try:
+                send_pong(session["socket"], session["decoder"])
+            except OSError:
+                pass   # the next read reports the lost connection
+            continue
+
+        if message.startswith("FORCED_LOGOUT"):
+            print(f"\n[SYSTEM] {message}")
+            session["socket"].close()
+            os._exit(0) # Force exit immediately
+
+        print(f"\n{message}")
+
+def start_client(host, port):
+    try:
+        context = create_ssl_context()
+    except FileNotFoundError:
+        print("Error: 'server.crt' not found. Cannot verify server.")
+        return
+
+    # Choose between login and registration
+    choice = input("Type 'login' to login or 'register' to create a new account: ").strip().lower()
     
+    username = input("Username: ")
+    password = input("Password: ")
+
+    print(f"Connecting to {host}:{port} securely...")
     try:
-        client_socket = context.wrap_socket(raw_socket, server_hostname=host)
-        client_socket.connect((host, port))
+        client_socket, decoder, response = login(context, host, port, choice, username, password)
     except Exception as e:
         print(f"Connection failed: {e}")
         return
 
+    session = {"socket": client_socket, "decoder": decoder,
+               "token": find_token(response, username), "closing": False}
     try:
-        # Choose between login and registration
-        choice = input("Type 'login' to login or 'register' to create a new account: ").strip().lower()
-        
-        username = input("Username: ")
-        password = input("Password: ")
-        
-        if choice == 'register':
-            # Send registration request
-            client_socket.send(f"REGISTER {username} {password}".encode())
-            response = client_socket.recv(1024).decode()
-            
-            if response.startswith("REGISTER_SUCCESS"):
-                print("Registration successful! Now logging you in...")
-                # After successful registration, server waits for login
-                client_socket.send(f"LOGIN {username} {password}".encode())
-                response = client_socket.recv(1024).decode()
-                if not response.startswith("AUTH_SUCCESS"):
-                    print(f"Login after registration failed: {response}")
-                    return
-            else:
+        if not response.startswith("AUTH_SUCCESS"):
+            if response.startswith("REGISTER_FAILED"):
                 print(f"Registration failed: {response}")
-                return
-        else:
-            # Send login request
-            client_socket.send(f"LOGIN {username} {password}".encode())
-            response = client_socket.recv(1024).decode()
-            if not response.startswith("AUTH_SUCCESS"):
+            else:
                 print(f"Login failed: {response}")
-                return
+            return
 
-        print("Login successful! Commands: /join <room>, /leave, /rooms, /subscribe <user>")
-        
-        threading.Thread(target=receive_messages, args=(client_socket,), daemon=True).start()
+        mode = "framed" if decoder is not None else "text"
+        print(f"Login successful ({mode} protocol)! Commands: /join <room>, /leave, /rooms, /subscribe <user>")
+
+        reconnect_fn = lambda: reconnect(session, context, host, port, username, password)
+        threading.Thread(target=receive_messages, args=(session, reconnect_fn), daemon=True).start()
         
         while True:
             msg = input()
             if msg.lower() == '/quit':
                 break
-            client_socket.send(msg.encode())
+            try:
+                send_lines(session["socket"], [msg], session["decoder"])
+            except OSError:
+                print("[SYSTEM] Not connected, message not sent.")
             
     except KeyboardInterrupt:
         pass
     finally:
-        client_socket.close()
+        session["closing"] = True
+        session["socket"].close()
 
 if __name__ == "__main__":    
     # Defaults
@@ -0,0 +1,60 @@
+"""
+Fixtures shared by the tests that run a real server.py: a throwaway
+certificate, made like the one in "Generate TLS Certificate", and server
+processes started in its directory. Those tests are skipped where the
+openssl command is not installed.
+"""
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+@pytest.fixture(scope="session")
+def cert_dir(tmp_path_factory):
+    """A directory holding server.crt and server.key for localhost."""
+    if not shutil.which("openssl"):
+        pytest.skip("needs the openssl command")
+    path = tmp_path_factory.mktemp("certs")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-keyout", "server.key",
+                    "-out", "server.crt", "-days", "1", "-nodes", "-subj", "/CN=localhost",
+                    "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1"],
+                   cwd=path, check=True, capture_output=True)
+    return path
+
+@pytest.fixture
+def start_server(cert_dir):
+    """Starts server.py with STATE_BACKEND=memory and the given environment
+    variables, and returns its port. The servers stop after the test."""
+    procs = []
+
+    def start(**env):
+        port = free_port()
+        env = dict(os.environ, **{"STATE_BACKEND": "memory", "METRICS_PORT": "0", **env, "PORT": str(port)})
+        proc = subprocess.Popen([sys.executable, SERVER_SCRIPT], cwd=cert_dir, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        procs.append(proc)
+        deadline = time.time() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                return port
+            except OSError:
+                if time.time() > deadline or proc.poll() is not None:
+                    pytest.fail("server did not start")
+                time.sleep(0.2)
+
+    yield start
+    for proc in procs:
+        proc.terminate()
+        proc.wait()
@@ -0,0 +1,74 @@
+"""
+Compact binary envelope for chat messages relayed between servers.
+
+    +-------+---------+------+-------+----------+------------+----------+-------------+
+    | magic | version | type | flags | ts (f64) | sender len | room len | content len |
+    |  1    |    1    |  1   |   1   |    8     |  2         |  2       |  4          |
+    +-------+---------+------+-------+----------+------------+----------+-------------+
+    followed by sender, room and content as raw UTF-8
+
+The magic byte can never start a JSON document, so receivers tell the two
+formats apart from the first byte and accept both (decode_payload). The
+content is left as bytes: servers only forward it to clients, which needs
+bytes anyway.
+"""
+import json
+import struct
+
+ENVELOPE_MAGIC = 0xC7
+ENVELOPE_VERSION = 1
+HEADER = struct.Struct("!BBBBdHHI")
+
+MESSAGE_TYPES = {"BROADCAST": 1, "PUBSUB": 2, "CHAT": 3}   # CHAT: one line for both room and followers
+TYPE_NAMES = {code: name for name, code in MESSAGE_TYPES.items()}
+
+FLAG_ROOM = 0x01        # room present (PUBSUB copies have none)
+FLAG_STREAM_ID = 0x02   # Redis appends the room history stream id after the content
+
+class EnvelopeError(ValueError):
+    """Raised for a truncated envelope or one from a newer, unknown version."""
+
+def encode_envelope(msg_type, sender, content, room=None, ts=0.0, stream_id_follows=False):
+    sender_bytes = sender.encode()
+    room_bytes = room.encode() if room is not None else b""
+    content_bytes = content.encode() if isinstance(content, str) else content
+    flags = FLAG_ROOM if room is not None else 0
+    if stream_id_follows:
+        flags |= FLAG_STREAM_ID
+    return b"".join((
+        HEADER.pack(ENVELOPE_MAGIC, ENVELOPE_VERSION, MESSAGE_TYPES[msg_type], flags, ts,
+                    len(sender_bytes), len(room_bytes), len(content_bytes)),
+        sender_bytes, room_bytes, content_bytes,
+    ))
+
+def decode_envelope(data):
+    """Returns a dict shaped like the JSON payload, with content as bytes."""
+    if len(data) < HEADER.size:
+        raise EnvelopeError("truncated envelope header")
+    magic, version, type_code, flags, ts, sender_len, room_len, content_len = HEADER.unpack_from(data)
+    if magic != ENVELOPE_MAGIC or version != ENVELOPE_VERSION:
+        raise EnvelopeError(f"unsupported envelope version {version}")
+    start = HEADER.size
+    end = start + sender_len + room_len + content_len
+    if len(data) < end:
+        raise EnvelopeError("truncated envelope body")
+    room_start = start + sender_len
+    content_start = room_start + room_len
+    message = {"type": TYPE_NAMES.get(type_code),
+               "sender": data[start:room_start].decode(),
+               "room": data[room_start:content_start].decode() if flags & FLAG_ROOM else None,
+               "content": bytes(data[content_start:end]),
+               "ts": ts}
+    if flags & FLAG_STREAM_ID and len(data) > end:
+        message["id"] = bytes(data[end:]).decode()
+    return message
+
+def is_envelope(data):
+    return len(data) > 0 and data[0] == ENVELOPE_MAGIC
+
+def decode_payload(data):
+    """Decodes a pub/sub payload in either format (bytes or str).
+    Raises EnvelopeError or json.JSONDecodeError (both ValueErrors)."""
+    if isinstance(data, (bytes, bytearray)) and is_envelope(data):
+        return decode_envelope(data)
+    return json.loads(data)
@@ -0,0 +1,495 @@
+"""
+Headless load generator for the chat cluster.
+
+Simulated users connect through client.py's TLS and LOGIN/REGISTER logic,
+spread round-robin over the server ports, and follow a fixed scenario:
+
+  1. connect  - register + login every user (connect/auth rate and latency)
+  2. join     - users /join one of --rooms rooms
+  3. subscribe- a fraction of users /subscribe to another user
+  4. chatter  - --senders users send at --rate msgs/s for --duration seconds;
+                every copy received is timed end to end
+  5. dup      - --dup-logins users log in again on another port (force logout)
+
+The report is one JSON document on stdout (progress goes to stderr):
+latency percentiles, throughput, connect/auth rate, delivery ratio and,
+when the server processes are known, per-server CPU and RSS. Lines a
+server's rate limits refused are counted as "throttled" and left out of
+the expected deliveries. Pass
+--baseline with an earlier report to fail (exit 1) on regressions.
+
+Against the docker-compose cluster (ports 8001-8050):
+    python loadgen.py --users 2000 --rooms 20 --duration 30
+
+Against servers started here on a local Redis:
+    python loadgen.py --spawn 4 --redis-port 6379 --users 500
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from client import create_ssl_context, login, read_message, send_lines, send_pong
+from protocol import PING_LINE
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+MARKER = "LG"   # chat lines look like "LG <send time ns> <sequence>"
+# Replies to lines a server's rate limits refused (RATE_LIMIT_REPLIES in server.py)
+THROTTLE_REPLIES = ("[SYSTEM] Slow down:", "[SYSTEM] This room is too busy")
+# Spawned servers run without rate limits unless --rate-limits is given
+NO_RATE_LIMITS = {"RATE_USER_MESSAGES": "0", "RATE_USER_COMMANDS": "0",
+                  "RATE_ROOM_MESSAGES": "0", "RATE_ROOM_CLUSTER": "0"}
+
+def percentiles(values, points=(50, 90, 99, 99.9)):
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {f"p{p:g}": round(values[min(len(values) - 1, int(len(values) * p / 100))], 3)
+              for p in points}
+    result["max"] = round(values[-1], 3)
+    result["mean"] = round(sum(values) / len(values), 3)
+    return result
+
+class Recorder:
+    """Thread-safe counters and samples shared by all simulated users."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency_ms = {"room": [], "pubsub": []}
+        self.received = 0
+        self.throttled = {}   # {username: lines refused by a rate limit}
+        self.recording = False
+
+    def delivered(self, kind, sent_ns):
+        latency = (time.time_ns() - sent_ns) / 1e6
+        with self.lock:
+            if self.recording:
+                self.latency_ms[kind].append(latency)
+                self.received += 1
+
+    def refused(self, username, count):
+        with self.lock:
+            if self.recording:
+                self.throttled[username] = self.throttled.get(username, 0) + count
+
+class SimUser:
+    def __init__(self, name, password, port):
+        self.name = name
+        self.password = password
+        self.port = port
+        self.sock = None
+        self.decoder = None
+        self.room = "lobby"
+        self.forced_out = threading.Event()
+        self.send_lock = threading.Lock()
+
+    def connect(self, context, host, choice="register"):
+        """Returns (ok, seconds taken, response)."""
+        started = time.perf_counter()
+        try:
+            sock, decoder, response = login(context, host, self.port, choice, self.name, self.password)
+        except OSError as e:
+            return False, time.perf_counter() - started, str(e)
+        elapsed = time.perf_counter() - started
+        if not response.startswith("AUTH_SUCCESS"):
+            sock.close()
+            return False, elapsed, response
+        self.sock, self.decoder = sock, decoder
+        return True, elapsed, response
+
+    def send(self, line):
+        with self.send_lock:
+            send_lines(self.sock, [line], self.decoder)
+
+    def receive(self, recorder):
+        sock, decoder = self.sock, self.decoder
+        while True:
+            try:
+                message = read_message(sock, decoder)
+            except OSError:
+                break
+            if not message:
+                break
+            if message == PING_LINE:
+                # Listeners that never send would otherwise be closed after IDLE_TIMEOUT
+                try:
+                    send_pong(sock, decoder)
+                except OSError:
+                    pass   # the next read reports the lost connection
+                continue
+            if message.startswith("FORCED_LOGOUT"):
+                self.forced_out.set()
+                break
+            throttled = sum(message.count(reply) for reply in THROTTLE_REPLIES)
+            if throttled:
+                recorder.refused(self.name, throttled)
+            # Text-mode reads may hold several messages; framed reads hold one
+            for line in message.split(f" {MARKER} ")[1:]:
+                try:
+                    sent_ns = int(line.split()[0])
+                except (ValueError, IndexError):
+                    continue
+                recorder.delivered("pubsub" if message.startswith("[PUB-SUB]") else "room", sent_ns)
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+# --- SERVER PROCESSES ---
+def spawn_servers(count, base_port, args):
+    """Starts local server.py processes against the given Redis."""
+    env = dict(os.environ, REDIS_HOST=args.redis_host, REDIS_PORT=str(args.redis_port),
+               SERVER_MODE=args.server_mode)
+    if not args.rate_limits:
+        env.update(NO_RATE_LIMITS)
+    log = open(args.server_log, "ab") if args.server_log else subprocess.DEVNULL
+    procs = {}
+    for port in range(base_port, base_port + count):
+        procs[port] = subprocess.Popen([sys.executable, SERVER_SCRIPT], env=dict(env, PORT=str(port)),
+                                       stdout=log, stderr=log)
+    for port in procs:
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            try:
+                socket.create_connection((args.host, port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.2)
+        else:
+            raise RuntimeError(f"server on port {port} did not start")
+    return procs
+
+def process_tree(pid):
+    """pid plus its descendants (the auth worker processes)."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, ()))
+    return tree
+
+def sample_process(pid):
+    """(cpu seconds, rss bytes) for a process and its descendants, from /proc."""
+    ticks = os.sysconf("SC_CLK_TCK")
+    cpu = rss = 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / ticks   # utime + stime
+            with open(f"/proc/{member}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1]) * 1024
+        except (OSError, IndexError, ValueError):
+            continue
+    return cpu, rss
+
+def sample_servers(pids):
+    return {name: sample_process(pid) for name, pid in pids.items()}
+
+def server_usage(before, after, elapsed):
+    usage = {}
+    for name, (cpu_after, rss) in after.items():
+        cpu_before = before.get(name, (cpu_after, 0))[0]
+        usage[name] = {"cpu_seconds": round(cpu_after - cpu_before, 3),
+                       "cpu_percent": round((cpu_after - cpu_before) / elapsed * 100, 1),
+                       "rss_mb": round(rss / 2 ** 20, 1)}
+    return usage
+
+def docker_usage():
+    """CPU/memory per container from `docker stats` (docker-compose cluster)."""
+    try:
+        output = subprocess.run(["docker", "stats", "--no-stream", "--format", "{{json .}}"],
+                                capture_output=True, text=True, timeout=30).stdout
+    except (OSError, subprocess.TimeoutExpired):
+        return {}
+    usage = {}
+    for line in output.splitlines():
+        stats = json.loads(line)
+        usage[stats["Name"]] = {"cpu_percent": float(stats["CPUPerc"].rstrip("%") or 0),
+                                "memory": stats["MemUsage"].split("/")[0].strip()}
+    return usage
+
+# --- SCENARIO ---
+def run_parallel(concurrency, fn, items):
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(fn, items))
+
+def phase_connect(users, context, args, recorder):
+    started = time.perf_counter()
+    results = run_parallel(args.concurrency, lambda u: u.connect(context, args.host), users)
+    elapsed = time.perf_counter() - started
+
+    failures = {}
+    for user, (ok, _, response) in zip(users, results):
+        if ok:
+            threading.Thread(target=user.receive, args=(recorder,), daemon=True).start()
+        else:
+            reason = response.split(":")[0] or "closed"
+            failures[reason] = failures.get(reason, 0) + 1
+    connected = [u for u in users if u.sock]
+    return connected, {
+        "attempted": len(users),
+        "connected": len(connected),
+        "failures": failures,
+        "seconds": round(elapsed, 3),
+        "rate_per_s": round(len(connected) / elapsed, 1) if elapsed else 0,
+        "latency_ms": percentiles([t * 1000 for ok, t, _ in results if ok]),
+    }
+
+def phase_join(users, rooms):
+    for i, user in enumerate(users):
+        user.room = f"lg-room-{i % rooms}"
+        user.send(f"/join {user.room}")
+
+def phase_subscribe(users, fraction):
+    """Returns {publisher: number of subscribers}."""
+    followers = {}
+    if len(users) < 2:
+        return followers
+    for user in users:
+        if random.random() < fraction:
+            target = random.choice([u for u in random.sample(users, 2) if u is not user])
+            user.send(f"/subscribe {target.name}")
+            followers[target.name] = followers.get(target.name, 0) + 1
+    return followers
+
+def phase_chatter(users, followers, args, recorder):
+    senders = random.sample(users, min(args.senders, len(users)))
+    members = {}
+    for user in users:
+        members[user.room] = members.get(user.room, 0) + 1
+
+    interval = 1.0 / args.rate
+    sent = expected = errors = 0
+    recorder.recording = True
+    started = time.perf_counter()
+    next_send = started
+    while time.perf_counter() - started < args.duration:
+        sender = senders[sent % len(senders)]
+        try:
+            sender.send(f"{MARKER} {time.time_ns()} {sent}")
+            expected += members[sender.room] - 1 + followers.get(sender.name, 0)
+        except OSError:
+            errors += 1
+        sent += 1
+        next_send += interval
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    send_elapsed = time.perf_counter() - started
+
+    time.sleep(args.drain)   # let in-flight copies arrive
+    recorder.recording = False
+    elapsed = time.perf_counter() - started
+    with recorder.lock:
+        received = recorder.received
+        throttled = dict(recorder.throttled)
+        room_latency = list(recorder.latency_ms["room"])
+        pubsub_latency = list(recorder.latency_ms["pubsub"])
+    # A refused line reaches nobody; it is reported apart from lost deliveries
+    by_name = {user.name: user for user in senders}
+    for name, count in throttled.items():
+        if name in by_name:
+            user = by_name[name]
+            expected -= count * (members[user.room] - 1 + followers.get(name, 0))
+    return {
+        "sent": sent,
+        "send_errors": errors,
+        "send_rate_per_s": round(sent / send_elapsed, 1),
+        "throttled": sum(throttled.values()),
+        "expected_deliveries": expected,
+        "delivered": received,
+        "delivery_ratio": round(received / expected, 4) if expected else None,
+        "throughput_msgs_per_s": round(received / elapsed, 1),
+        "latency_ms": percentiles(room_latency + pubsub_latency),
+        "room_latency_ms": percentiles(room_latency),
+        "pubsub_latency_ms": percentiles(pubsub_latency),
+    }, elapsed
+
+def phase_duplicate_logins(users, context, args, ports, recorder):
+    victims = random.sample(users, min(args.dup_logins, len(users)))
+
+    def relogin(user):
+        other_ports = [p for p in ports if p != user.port] or ports
+        twin = SimUser(user.name, user.password, random.choice(other_ports))
+        ok, elapsed, _ = twin.connect(context, args.host, choice="login")
+        forced = user.forced_out.wait(5)
+        if ok:
+            threading.Thread(target=twin.receive, args=(recorder,), daemon=True).start()
+        return ok, elapsed, forced, twin
+
+    results = run_parallel(args.concurrency, relogin, victims)
+    return [twin for *_, twin in results], {
+        "attempted": len(victims),
+        "succeeded": sum(1 for ok, *_ in results if ok),
+        "old_session_forced_out": sum(1 for _, _, forced, _ in results if forced),
+        "latency_ms": percentiles([t * 1000 for ok, t, _, _ in results if ok]),
+    }
+
+# --- REGRESSIONS ---
+REGRESSION_CHECKS = [
+    # (path in the report, True if higher is better)
+    (("chat", "latency_ms", "p99"), False),
+    (("chat", "latency_ms", "p50"), False),
+    (("chat", "throughput_msgs_per_s"), True),
+    (("chat", "delivery_ratio"), True),
+    (("connect", "rate_per_s"), True),
+]
+
+def lookup(report, path):
+    for key in path:
+        if not isinstance(report, dict) or key not in report:
+            return None
+        report = report[key]
+    return report
+
+def compare(report, baseline, tolerance):
+    regressions = []
+    for path, higher_is_better in REGRESSION_CHECKS:
+        current, previous = lookup(report, path), lookup(baseline, path)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append({"metric": ".".join(path), "baseline": previous,
+                                "current": current, "change": round(change, 4)})
+    return regressions
+
+def parse_ports(spec):
+    if "-" in spec:
+        first, last = spec.split("-")
+        return list(range(int(first), int(last) + 1))
+    return [int(p) for p in spec.split(",")]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--ports", default="8001-8050", help="range 8001-8050 or list 8001,8002")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--subscribe-fraction", type=float, default=0.2)
+    parser.add_argument("--senders", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=200, help="chat messages per second, all senders")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of chatter")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for late deliveries")
+    parser.add_argument("--dup-logins", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=64, help="parallel logins")
+    parser.add_argument("--spawn", type=int, default=0, help="start N local servers on the first N ports")
+    parser.add_argument("--server-mode", default="threaded", help="SERVER_MODE for spawned servers")
+    parser.add_argument("--server-log", help="append spawned servers' logs to this file")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the spawned servers' default rate limits instead of disabling them")
+    parser.add_argument("--redis-host", default="127.0.0.1")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--pids", default="", help="name=pid,... of running servers to sample")
+    parser.add_argument("--docker", action="store_true", help="sample `docker stats` after the run")
+    parser.add_argument("--baseline", help="earlier report; exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--output", help="also write the report to this file")
+    args = parser.parse_args()
+
+    report_out = sys.stdout
+    sys.stdout = sys.stderr   # client.py prints progress; keep stdout pure JSON
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+    threading.stack_size(256 * 1024)   # one receiver thread per simulated user
+
+    ports = parse_ports(args.ports)
+    procs = {}
+    if args.spawn:
+        ports = ports[:args.spawn]
+        print(f"Starting {len(ports)} servers on ports {ports[0]}-{ports[-1]}")
+        procs = spawn_servers(len(ports), ports[0], args)
+    pids = {f"port-{port}": proc.pid for port, proc in procs.items()}
+    for entry in filter(None, args.pids.split(",")):
+        name, pid = entry.split("=")
+        pids[name] = int(pid)
+
+    context = create_ssl_context()
+    recorder = Recorder()
+    run_id = uuid.uuid4().hex[:6]
+    users = [SimUser(f"lg{run_id}u{i}", "loadgen", ports[i % len(ports)]) for i in range(args.users)]
+    report = {"run_id": run_id, "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+              "config": {k: v for k, v in vars(args).items() if k not in ("baseline", "output")}}
+    extra = []
+    try:
+        before = sample_servers(pids)
+        print(f"Connecting {len(users)} users...")
+        users, report["connect"] = phase_connect(users, context, args, recorder)
+        after_connect = sample_servers(pids)
+        if not users:
+            raise RuntimeError("no user could connect")
+
+        print("Joining rooms and subscribing...")
+        phase_join(users, args.rooms)
+        followers = phase_subscribe(users, args.subscribe_fraction)
+        report["subscriptions"] = sum(followers.values())
+        time.sleep(1)   # let joins and subscriptions settle
+
+        print(f"Chatting for {args.duration}s at {args.rate} msgs/s...")
+        chat_start = sample_servers(pids)
+        report["chat"], chat_elapsed = phase_chatter(users, followers, args, recorder)
+        chat_end = sample_servers(pids)
+
+        print(f"Duplicate logins: {args.dup_logins}...")
+        extra, report["duplicate_logins"] = phase_duplicate_logins(users, context, args, ports, recorder)
+
+        report["servers"] = {
+            "connect": server_usage(before, after_connect, report["connect"]["seconds"]),
+            "chat": server_usage(chat_start, chat_end, chat_elapsed),
+        }
+        if args.docker:
+            report["servers"]["docker"] = docker_usage()
+    finally:
+        for user in users + extra:
+            user.close()
+        for proc in procs.values():
+            proc.terminate()
+        for proc in procs.values():
+            proc.wait()
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(report, json.load(f), args.tolerance)
+        status = 1 if report["regressions"] else 0
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    report_out.write(text + "\n")
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Queue-based logging for server.py.
+
+Log calls only put the record on a queue; a background QueueListener
+formats it and writes it to stdout, so a slow terminal or log collector
+never blocks a connection thread or the event loop. Records are formatted
+lazily, in the listener, so hot-path calls should use %-style arguments.
+
+Noisy categories (chat lines, commands, session churn) get a child logger
+with a RateLimitFilter that samples and rate limits records and counts
+what it drops. take_dropped() reports those counts.
+
+The writer thread does not survive fork(): a forked worker calls
+setup_logging() again to get its own queue and writer.
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues records unformatted and drops them when the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Same process, so nothing needs pickling: the listener formats it
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1   # called under the handler lock
+
+class RateLimitFilter(logging.Filter):
+    """Keeps one record in `sample_every`, then at most `rate` records per second."""
+
+    def __init__(self, rate=0, sample_every=1):
+        super().__init__()
+        self.rate = rate
+        self.sample_every = max(sample_every, 1)
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.seen = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        with self.lock:
+            self.seen += 1
+            if self.seen % self.sample_every:
+                self.dropped += 1
+                return False
+            if self.rate:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens < 1:
+                    self.dropped += 1
+                    return False
+                self.tokens -= 1
+        return True
+
+queue_handler = None
+listener = None
+category_filters = {}   # {category: RateLimitFilter}
+
+def setup_logging(fmt, level=logging.INFO, queue_size=10000):
+    """Routes the root logger through a bounded queue to a stdout writer thread."""
+    global queue_handler, listener
+    first_setup = listener is None
+    log_queue = queue.Queue(maxsize=queue_size)
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter(fmt))
+    listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+
+    queue_handler = DroppingQueueHandler(log_queue)
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    listener.start()
+    if first_setup:
+        atexit.register(stop_logging)   # flush what is queued on exit
+
+def stop_logging():
+    """Writes out what is still queued and stops the writer thread."""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+def category_logger(parent, category, rate=0, sample_every=1):
+    """Child logger for a noisy category, sampled and rate limited."""
+    category_filter = category_filters[category] = RateLimitFilter(rate, sample_every)
+    child = parent.getChild(category)
+    child.addFilter(category_filter)
+    return child
+
+def take_dropped():
+    """{category: records dropped since the last call}, plus "queue_full"."""
+    dropped = {}
+    for category, category_filter in category_filters.items():
+        with category_filter.lock:
+            dropped[category], category_filter.dropped = category_filter.dropped, 0
+    if queue_handler:
+        with queue_handler.lock:
+            dropped["queue_full"], queue_handler.dropped = queue_handler.dropped, 0
+    return dropped
@@ -0,0 +1,117 @@
+"""
+Length-prefixed wire protocol shared by server.py and client.py.
+
+A framed client opens the connection with FRAMED_MAGIC and then sends frames:
+
+    +----------------+------------+-----------------+
+    | length (4, BE) | type (1)   | payload (length) |
+    +----------------+------------+-----------------+
+
+Any number of frames may be packed into one write (pipelining). A server that
+does not recognise the magic closes the connection, and the client falls back
+to the plain text mode. There a client's recv() is one message, and every
+server message ends with LINE_END, so a client can also split a read that
+holds several. Newlines inside a message are sent as spaces.
+
+A server pings a client that has been silent for a while: an empty
+FRAME_PING, or the line PING_LINE in text mode. The client answers with
+FRAME_PONG or PONG_LINE.
+"""
+import struct
+
+FRAMED_MAGIC = b"\xffCHAT/1\n"   # never valid UTF-8, so a text server rejects it
+HEADER = struct.Struct("!IB")    # payload length, frame type
+
+FRAME_TEXT = 1                   # a command, chat line or server message (UTF-8)
+FRAME_PING = 2                   # server -> client liveness check, empty
+FRAME_PONG = 3                   # client -> server answer, empty
+
+PING_LINE = "PING"               # text mode equivalents
+PONG_LINE = "PONG"
+LINE_END = b"\n"                 # ends every server message in text mode
+
+MAX_FRAME_SIZE = 1024 * 1024
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+class ProtocolError(ValueError):
+    """Raised when the peer sends a malformed or oversized frame."""
+
+def encode_frame(payload, frame_type=FRAME_TEXT):
+    return HEADER.pack(len(payload), frame_type) + payload
+
+def encode_frames(payloads, frame_type=FRAME_TEXT):
+    """Packs several payloads into one buffer so they go out in a single write."""
+    return b"".join(encode_frame(p, frame_type) for p in payloads)
+
+class FrameDecoder:
+    """
+    Parses frames out of one reusable receive buffer.
+
+    Data is received straight into the buffer (recv_into) and frames are
+    returned as memoryview slices of it, so nothing is copied until the
+    caller decodes the payload. Views are only valid until the next
+    recv_from()/feed() call.
+    """
+
+    def __init__(self, size=DEFAULT_BUFFER_SIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0   # first unparsed byte
+        self.end = 0     # end of received data
+
+    def _make_room(self, needed):
+        """Ensures `needed` free bytes after end, compacting or growing the buffer."""
+        if len(self.buffer) - self.end >= needed:
+            return
+        pending = self.end - self.start
+        if len(self.buffer) - pending >= needed:
+            # Slide unparsed bytes to the front (same size, no reallocation)
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        else:
+            size = len(self.buffer)
+            while size - pending < needed:
+                size *= 2
+            new_buffer = bytearray(size)
+            new_buffer[:pending] = self.buffer[self.start:self.end]
+            self.buffer = new_buffer
+            self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = pending
+
+    def _missing(self):
+        """Bytes still needed to complete the frame at the parse position."""
+        pending = self.end - self.start
+        if pending < HEADER.size:
+            return HEADER.size - pending
+        length, _ = HEADER.unpack_from(self.buffer, self.start)
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Frame of {length} bytes exceeds limit")
+        return HEADER.size + length - pending
+
+    def recv_from(self, sock):
+        """Reads from sock directly into the buffer. Returns bytes read (0 on EOF)."""
+        self._make_room(max(4096, self._missing()))
+        nbytes = sock.recv_into(self.view[self.end:])
+        self.end += nbytes
+        return nbytes
+
+    def feed(self, data):
+        """Appends already-received bytes (e.g. from an asyncio stream)."""
+        self._make_room(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def frames(self):
+        """Yields (frame_type, payload memoryview) for every complete frame."""
+        while self.end - self.start >= HEADER.size:
+            length, frame_type = HEADER.unpack_from(self.buffer, self.start)
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError(f"Frame of {length} bytes exceeds limit")
+            frame_end = self.start + HEADER.size + length
+            if frame_end > self.end:
+                return
+            payload = self.view[self.start + HEADER.size:frame_end]
+            self.start = frame_end
+            yield frame_type, payload
+        if self.start == self.end:
+            self.start = self.end = 0
@@ -0,0 +1,54 @@
+"""
+Token buckets for throttling clients in server.py.
+
+A bucket holds up to `burst` tokens and refills at `rate` tokens per
+second; every request takes one and is refused when none is left. A
+BucketTable keeps one bucket per key (a username, a room) and forgets the
+ones that have refilled completely, which are no different from new ones.
+
+    messages = BucketTable(rate=5, burst=20)
+    if not messages.take("alice"):
+        ...   # throttled
+"""
+import threading
+import time
+
+PRUNE_INTERVAL = 60   # seconds between sweeps for full buckets
+
+def take_token(bucket, now, rate, burst):
+    """Refills a [tokens, updated] bucket up to now and takes a token from
+    it. False if none is left."""
+    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+    bucket[1] = now
+    if bucket[0] < 1:
+        return False
+    bucket[0] -= 1
+    return True
+
+class BucketTable:
+    """Token buckets by key. A rate of 0 disables the limit."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.buckets = {}   # {key: [tokens, time.monotonic() of the last refill]}
+        self.lock = threading.Lock()
+        self.pruned = time.monotonic()
+
+    def take(self, key):
+        """Takes a token from key's bucket. False if it is empty."""
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.setdefault(key, [self.burst, now])
+            allowed = take_token(bucket, now, self.rate, self.burst)
+            if now - self.pruned > PRUNE_INTERVAL:
+                self.prune(now)
+        return allowed
+
+    def prune(self, now):
+        """Drops buckets that would be full by now. Called under the lock."""
+        self.buckets = {key: bucket for key, bucket in self.buckets.items()
+                        if bucket[0] + (now - bucket[1]) * self.rate < self.burst}
+        self.pruned = now
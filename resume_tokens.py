@@ -0,0 +1,49 @@
+"""
+Signed resume tokens, so a reconnecting client can skip bcrypt.
+
+    <username>.<expires>.<token id>.<signature>
+
+The signature is HMAC-SHA256 over the first three fields with a secret
+shared by all servers, so forged or expired tokens are rejected without
+touching Redis. The server also stores the token id per user in Redis:
+issuing a new token (every LOGIN or RESUME) revokes the previous one.
+"""
+import hashlib
+import hmac
+import re
+import secrets
+import time
+
+TOKEN_ID_BYTES = 16
+
+class TokenError(ValueError):
+    """Raised for a malformed, forged or expired token."""
+
+def sign(secret, payload):
+    return hmac.new(secret, payload.encode(), hashlib.sha256).hexdigest()
+
+def issue_token(secret, username, ttl):
+    """Returns (token, token id)."""
+    token_id = secrets.token_hex(TOKEN_ID_BYTES)
+    payload = f"{username}.{int(time.time()) + ttl}.{token_id}"
+    return f"{payload}.{sign(secret, payload)}", token_id
+
+def verify_token(secret, token):
+    """Checks signature and expiry. Returns (username, token id)."""
+    try:
+        username, expires, token_id, signature = token.rsplit(".", 3)
+        expires = int(expires)
+    except ValueError:
+        raise TokenError("malformed token") from None
+    if not hmac.compare_digest(signature, sign(secret, f"{username}.{expires}.{token_id}")):
+        raise TokenError("bad signature")
+    if expires < time.time():
+        raise TokenError("token expired")
+    return username, token_id
+
+def find_token(response, username):
+    """Extracts username's token from an AUTH_SUCCESS reply, or returns None.
+    Text-mode replies can arrive glued to the next message, hence the pattern."""
+    pattern = re.escape(username) + r"\.\d+\.[0-9a-f]{%d}\.[0-9a-f]{64}" % (TOKEN_ID_BYTES * 2)
+    match = re.search(pattern, response)
+    return match.group(0) if match else None
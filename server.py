@@ -7,300 +7,1593 @@ import json
 import os
 import logging
 import time
+import uuid
+import asyncio
+import resource
+import select
+import multiprocessing
+import signal
+import struct
+from collections import deque
+from contextlib import nullcontext
+from queue import Full, Queue
+from concurrent.futures import ProcessPoolExecutor
+from envelope import ENVELOPE_VERSION, decode_payload, encode_envelope
+from resume_tokens import TokenError, issue_token, verify_token
+from protocol import (FRAMED_MAGIC, FRAME_PING, FRAME_TEXT, LINE_END, PING_LINE, PONG_LINE, FrameDecoder,
+                      ProtocolError, encode_frame)
+from metrics import Counter, GaugeCallback, Histogram, start_metrics_server
+from logpipeline import category_logger, setup_logging, stop_logging, take_dropped
+from state import MemoryBackend, RedisBackend
+from ratelimit import BucketTable
 
 # --- LOGGING SETUP---
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# Records are queued and written by a background thread (logpipeline.py).
+# Chat lines, commands and session churn are sampled and rate limited per
+# category: LOG_RATE_<CATEGORY> records/s (0 = unlimited) and
+# LOG_SAMPLE_<CATEGORY> (keep 1 in N). Hot-path calls use %-style args so
+# formatting happens on the writer thread. The writer starts once the auth
+# workers are forked (see AUTH WORKER PROCESSES).
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+LOG_STATS_INTERVAL = int(os.environ.get("LOG_STATS_INTERVAL", 60))
+
 logger = logging.getLogger(__name__)
 
+def make_category_logger(category, default_rate):
+    return category_logger(logger, category,
+                           rate=float(os.environ.get(f"LOG_RATE_{category.upper()}", default_rate)),
+                           sample_every=int(os.environ.get(f"LOG_SAMPLE_{category.upper()}", 1)))
+
+message_log = make_category_logger("messages", 20)    # chat lines
+command_log = make_category_logger("commands", 100)   # /join, /rooms, /subscribe...
+session_log = make_category_logger("sessions", 100)   # logins, lobby joins, disconnects
+
 # --- CONFIGURATION ---
 HOST = '0.0.0.0'
 PORT = int(os.environ.get("PORT", 8000))
 REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "redis")  # "redis" or "memory" (one process, no Redis)
+SERVER_MODE = os.environ.get("SERVER_MODE", "threaded")  # "threaded" or "asyncio"
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", 1))  # processes sharing PORT via SO_REUSEPORT
+WORKER_RESTART_DELAY = 1.0    # seconds before restarting a worker that crashed soon after starting (doubles, max 30)
+WORKER_MIN_UPTIME = 10.0      # a worker that lived longer than this is restarted immediately
+ASYNC_BACKLOG = int(os.environ.get("ASYNC_BACKLOG", 4096))
+PUBSUB_POLL_INTERVAL = 0.05  # seconds the listener waits before re-checking wanted channels
+AUTH_WORKERS = int(os.environ.get("AUTH_WORKERS", max((os.cpu_count() or 1) // SERVER_WORKERS, 1)))  # per server process
+AUTH_QUEUE_LIMIT = int(os.environ.get("AUTH_QUEUE_LIMIT", 64))       # queued + running bcrypt jobs
+AUTH_STATS_INTERVAL = int(os.environ.get("AUTH_STATS_INTERVAL", 60))  # seconds between stats log lines
+AUTH_BUSY_REPLY = "AUTH_BUSY: Server busy, retry later."
+ROOMS_PAGE_SIZE = int(os.environ.get("ROOMS_PAGE_SIZE", 20))
+FORCE_LOGOUT_TIMEOUT = float(os.environ.get("FORCE_LOGOUT_TIMEOUT", 2.0))  # seconds to wait for the eviction ack
+OUTBOUND_QUEUE_SIZE = int(os.environ.get("OUTBOUND_QUEUE_SIZE", 256))     # messages queued per client
+OUTBOUND_POLICY = os.environ.get("OUTBOUND_POLICY", "disconnect")         # "drop_oldest", "coalesce" or "disconnect"
+OUTBOUND_MAX_BYTES = int(os.environ.get("OUTBOUND_MAX_BYTES", 1024 * 1024))  # coalesce policy byte cap
+OUTBOUND_SEND_TIMEOUT = float(os.environ.get("OUTBOUND_SEND_TIMEOUT", 10.0))  # seconds a single send may block
+OUTBOUND_STATS_INTERVAL = int(os.environ.get("OUTBOUND_STATS_INTERVAL", 60))
+OUTBOUND_FLUSH_DELAY = float(os.environ.get("OUTBOUND_FLUSH_DELAY", 0.001))  # seconds to gather a batch before writing
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))  # HTTP port for /metrics, 0 disables it
+DISPATCH_WORKERS = int(os.environ.get("DISPATCH_WORKERS", 4))  # listener fan-out threads, 0 = inline
+DISPATCH_QUEUE_SIZE = int(os.environ.get("DISPATCH_QUEUE_SIZE", 10000))  # messages waiting per shard
+PUBSUB_ENCODING = os.environ.get("PUBSUB_ENCODING", "auto")  # "json", "binary" or "auto"
+CODEC_HEARTBEAT_INTERVAL = 10  # seconds between codec adverts / auto-negotiation checks
+INSTANCE_ID = uuid.uuid4().hex  # identifies this process in Redis
+TLS_HANDSHAKE_TIMEOUT = float(os.environ.get("TLS_HANDSHAKE_TIMEOUT", 5.0))  # seconds a client may take to finish the handshake
+TLS_HANDSHAKE_CONCURRENCY = int(os.environ.get("TLS_HANDSHAKE_CONCURRENCY", 128))  # handshakes in progress before accept waits
+TLS_SESSION_TICKETS = int(os.environ.get("TLS_SESSION_TICKETS", 2))  # TLS 1.3 resumption tickets sent per handshake
+RESUME_TOKEN_TTL = int(os.environ.get("RESUME_TOKEN_TTL", 86400))  # seconds a resume token stays valid
+HISTORY_MAXLEN = int(os.environ.get("HISTORY_MAXLEN", 1000))  # messages kept per room (approximate), 0 disables history
+HISTORY_TTL = int(os.environ.get("HISTORY_TTL", 7 * 86400))   # seconds a room's history outlives its last message
+HISTORY_REPLAY = int(os.environ.get("HISTORY_REPLAY", 20))     # recent messages sent when joining a room
+PUBSUB_RECONNECT_DELAY = 1.0  # seconds between Redis listener reconnect attempts
+SERVER_LEASE_TTL = int(os.environ.get("SERVER_LEASE_TTL", 30))  # seconds a server's sessions outlive its last heartbeat
+REAP_BATCH = 500  # sessions removed per reap script call
+PING_INTERVAL = float(os.environ.get("PING_INTERVAL", 30))   # seconds of client silence before a PING, 0 disables
+IDLE_TIMEOUT = float(os.environ.get("IDLE_TIMEOUT", 120))    # seconds of silence before a logged-in connection is closed, 0 disables
+READ_TIMEOUT = float(os.environ.get("READ_TIMEOUT", 30))     # seconds of silence allowed before login, 0 disables
+SWEEP_INTERVAL = min([t for t in (PING_INTERVAL, IDLE_TIMEOUT, READ_TIMEOUT) if t] + [10]) / 2  # seconds between liveness sweeps
+TCP_KEEPALIVE_IDLE = int(os.environ.get("TCP_KEEPALIVE_IDLE", 60))       # seconds idle before the first probe
+TCP_KEEPALIVE_INTERVAL = int(os.environ.get("TCP_KEEPALIVE_INTERVAL", 10))  # seconds between probes
+TCP_KEEPALIVE_COUNT = int(os.environ.get("TCP_KEEPALIVE_COUNT", 5))      # unanswered probes before the kernel drops it
+RATE_USER_MESSAGES = float(os.environ.get("RATE_USER_MESSAGES", 5))       # chat lines per second per user, 0 disables
+RATE_USER_MESSAGES_BURST = int(os.environ.get("RATE_USER_MESSAGES_BURST", 20))
+RATE_USER_COMMANDS = float(os.environ.get("RATE_USER_COMMANDS", 2))       # commands per second per user, 0 disables
+RATE_USER_COMMANDS_BURST = int(os.environ.get("RATE_USER_COMMANDS_BURST", 10))
+RATE_ROOM_MESSAGES = float(os.environ.get("RATE_ROOM_MESSAGES", 50))      # chat lines per second per room from this server, 0 disables
+RATE_ROOM_MESSAGES_BURST = int(os.environ.get("RATE_ROOM_MESSAGES_BURST", 100))
+RATE_ROOM_CLUSTER = float(os.environ.get("RATE_ROOM_CLUSTER", 0))         # chat lines per second per room from all servers, 0 disables
+RATE_ROOM_CLUSTER_BURST = int(os.environ.get("RATE_ROOM_CLUSTER_BURST", 100))
+
+# --- AUTH WORKER PROCESSES ---
+# bcrypt runs in a process pool (see AUTH WORKER POOL). Its workers are
+# forked here, before setup_logging starts the log writer thread: a fork
+# copies only the calling thread, so a lock held by any other thread would
+# stay locked in the workers. A pre-fork worker does the same in run_worker.
+auth_pool = None
+
+def fork_auth_workers():
+    global auth_pool
+    auth_pool = ProcessPoolExecutor(max_workers=AUTH_WORKERS,
+                                    mp_context=multiprocessing.get_context("fork"))
+    auth_pool.submit(bcrypt.gensalt).result()   # starts every worker
+
+if SERVER_WORKERS <= 1:
+    fork_auth_workers()
+setup_logging('%(asctime)s - %(levelname)s - %(message)s', queue_size=LOG_QUEUE_SIZE)
+
+# --- METRICS ---
+# Exposed in the Prometheus text format on METRICS_PORT. Each update is one
+# uncontended lock, so they stay on in production.
+connections_total = Counter("chat_connections_total", "Client connections accepted")
+command_seconds = Histogram("chat_command_seconds", "Time to handle one client line", ["command"])
+auth_seconds = Histogram("chat_auth_seconds", "LOGIN/REGISTER handling time, including bcrypt", ["result"])
+auth_job_seconds = Histogram("chat_auth_job_seconds", "bcrypt job time in the auth pool, including queueing")
+auth_rejected = Counter("chat_auth_rejected_total", "bcrypt jobs rejected because the auth queue was full")
+redis_seconds = Histogram("chat_redis_seconds", "State backend call time (a Redis round-trip unless STATE_BACKEND=memory)", ["op"])
+fanout_seconds = Histogram("chat_fanout_seconds", "Time to queue one relayed message for local recipients", ["type"])
+fanout_recipients = Counter("chat_fanout_recipients_total", "Relayed message copies queued for local clients", ["type"])
+pubsub_messages = Counter("chat_pubsub_messages_total", "Messages received by the Redis listener", ["channel"])
+pubsub_lag_seconds = Histogram("chat_pubsub_lag_seconds", "Delay from publish to receipt by the Redis listener")
+outbound_events = Counter("chat_outbound_events_total", "Outbound queue overflow handling", ["event"])
+resumes = Counter("chat_resumes_total", "RESUME attempts", ["result"])
+sessions_reaped = Counter("chat_sessions_reaped_total", "Sessions removed because their server's lease expired")
+rate_limited = Counter("chat_rate_limited_total", "Client lines refused by a rate limit", ["limit"])
+tls_handshakes = Counter("chat_tls_handshakes_total", "TLS handshakes by outcome", ["result"])
+connections_swept = Counter("chat_connections_swept_total", "Connections closed for staying silent", ["reason"])
+tls_handshake_seconds = Histogram("chat_tls_handshake_seconds", "Server-side TLS handshake time", ["kind"])
+log_records_dropped = Counter("chat_log_records_dropped_total", "Log records sampled out, rate limited or lost to a full queue", ["category"])
+
+KNOWN_COMMANDS = ("join", "leave", "rooms", "subscribe", "unsubscribe")
+
+def command_name(data):
+    """Metric label for a client line: its command, or "chat"."""
+    if data.startswith("/"):
+        name = data[1:].split(" ", 1)[0]
+        if name in KNOWN_COMMANDS:
+            return name
+    return "chat"
+
+def channel_kind(channel):
+    """Metric label for a pub/sub channel: "room", "pub" or "control"."""
+    return "control" if channel == "control_channel" else channel.split(":", 1)[0]
+
+def room_connection_counts():
+    counts = {}
+    for table in (local, async_local):
+        for room, members in list(table.rooms.items()):
+            counts[(room,)] = counts.get((room,), 0) + len(members)
+    return counts
+
+GaugeCallback("chat_active_connections", "Authenticated local connections",
+              lambda: len(local.clients) + len(async_local.clients))
+GaugeCallback("chat_room_connections", "Local connections per room", room_connection_counts, ["room"])
+GaugeCallback("chat_pubsub_channels", "Room/publisher channels this server subscribes to",
+              lambda: len(local.channel_refs) + len(async_local.channel_refs))
+GaugeCallback("chat_auth_queue_depth", "bcrypt jobs queued or running", lambda: auth_stats["depth"])
+GaugeCallback("chat_dispatch_backlog", "Messages waiting per listener dispatch shard",
+              lambda: {(str(shard),): work.qsize() for shard, work in enumerate(dispatch_queues)}, ["shard"])
+GaugeCallback("chat_outbound_queued", "Messages waiting in outbound queues",
+              lambda: sum(len(q.items) for q in list(outbound_queues.values()))
+                      + sum(len(q.items) for q, _ in list(async_outbound.values())))
+
+def log_dropped_records():
+    """Reports log records dropped by sampling, rate limits or a full queue."""
+    while True:
+        time.sleep(LOG_STATS_INTERVAL)
+        dropped = take_dropped()
+        for category, count in dropped.items():
+            if count:
+                log_records_dropped.labels(category).inc(count)
+        if any(dropped.values()):
+            logger.info("Log records dropped: %s", " ".join(f"{c}={n}" for c, n in dropped.items()))
+
+def start_metrics():
+    if METRICS_PORT:
+        port = METRICS_PORT + worker_index   # one port per pre-fork worker
+        start_metrics_server(port)
+        logger.info(f"Metrics available on http://{HOST}:{port}/metrics")
+
+# --- STATE BACKEND ---
+# Users, sessions, rooms, follows and history live in a backend from
+# state.py: Redis, shared by every server, or this process's memory for a
+# single server without Redis.
+def open_state_backend():
+    if STATE_BACKEND == "memory":
+        if SERVER_WORKERS > 1:
+            logger.error("STATE_BACKEND=memory keeps state in one process; set SERVER_WORKERS=1. Exiting.")
+            exit(1)
+        logger.info("Keeping state in memory (single node, lost on restart)")
+        return MemoryBackend(HISTORY_MAXLEN)
+    try:
+        backend = RedisBackend(REDIS_HOST, REDIS_PORT, HISTORY_MAXLEN, HISTORY_TTL)
+        logger.info(f"Connected to Redis at {REDIS_HOST}:{REDIS_PORT}")
+        return backend
+    except redis.ConnectionError:
+        logger.error("Could not connect to Redis. Exiting.")
+        exit(1)
+
+state = open_state_backend()
+
+# --- STEPS ---
+# Session, command and relay logic is shared by both engines. It is written
+# as generators that yield each backend call and bcrypt job instead of
+# making it: run_steps makes the call on the calling thread (threaded
+# engine), async_run_steps awaits the backend's async_ twin or the pool's
+# future (asyncio engine). The code between two yields is plain and
+# synchronous, so the engines only differ in their socket I/O.
+def call(op, method, *args):
+    """Step: state.<method>(*args), timed as chat_redis_seconds{op} when op is set."""
+    return "state", op, method, args
+
+def auth_job(fn, *args):
+    """Step: fn(*args) on the auth pool. Raises AuthBusy when its queue is full."""
+    return "auth", None, fn, args
+
+def timed(op):
+    return redis_seconds.labels(op).time() if op else nullcontext()
+
+def run_steps(steps):
+    """Runs a steps generator to the end on this thread and returns its
+    value. A step that fails raises its exception in the generator."""
+    result = error = None
+    while True:
+        try:
+            step = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as done:
+            return done.value
+        kind, op, target, args = step
+        try:
+            if kind == "auth":
+                result = submit_auth_job(target, *args).result()
+            else:
+                with timed(op):
+                    result = getattr(state, target)(*args)
+            error = None
+        except Exception as e:
+            result, error = None, e
+
+async def async_run_steps(steps):
+    """run_steps for the event loop: nothing it waits for blocks the loop."""
+    result = error = None
+    while True:
+        try:
+            step = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as done:
+            return done.value
+        kind, op, target, args = step
+        try:
+            if kind == "auth":
+                # bcrypt is CPU bound, keep it off the event loop
+                result = await asyncio.wrap_future(submit_auth_job(target, *args))
+            else:
+                with timed(op):
+                    result = await getattr(state, "async_" + target)(*args)
+            error = None
+        except Exception as e:
+            result, error = None, e
+
+# --- PUB/SUB ENCODING ---
+# Chat payloads go between servers as JSON or as the binary envelope in
+# envelope.py. Every server decodes both. With PUBSUB_ENCODING=auto a server
+# publishes binary only while every subscriber of control_channel (one per
+# server) advertises the envelope, so older servers keep getting JSON.
+#
+# A chat line normally goes out as one CHAT message published to both the
+# room channel and the sender's publisher channel, and each receiving server
+# formats it for the channel it arrived on. Servers that only know the
+# separate BROADCAST and PUBSUB copies do not advertise chat_relay, and while
+# one is subscribed everyone publishes the two copies instead.
+# With STATE_BACKEND=memory every reader is this process, which knows both.
+publish_binary = PUBSUB_ENCODING == "binary" or (PUBSUB_ENCODING == "auto" and not state.clustered)
+publish_merged = not state.clustered
+CHAT_RELAY_VERSION = 1
+
+def negotiate_pubsub_encoding():
+    """Advertises what we can read and picks what to publish from what every
+    server advertises: the format in auto mode, and merged chat lines."""
+    global publish_binary, publish_merged
+    while True:
+        try:
+            adverts = state.advertise(INSTANCE_ID, {"pubsub_codec": ENVELOPE_VERSION,
+                                                    "chat_relay": CHAT_RELAY_VERSION},
+                                      CODEC_HEARTBEAT_INTERVAL * 3)
+            servers = state.subscriber_count("control_channel")
+            if PUBSUB_ENCODING == "auto":
+                capable = sum(1 for advert in adverts if advert.get("pubsub_codec") == ENVELOPE_VERSION)
+                binary = capable >= servers > 0
+                if binary != publish_binary:
+                    logger.info(f"Pub/sub encoding: {'binary' if binary else 'json'} "
+                                f"({capable} capable of {servers} servers)")
+                publish_binary = binary
+            capable = sum(1 for advert in adverts if advert.get("chat_relay") == CHAT_RELAY_VERSION)
+            merged = capable >= servers > 0
+            if merged != publish_merged:
+                logger.info(f"Chat relay: {'merged' if merged else 'separate copies'} "
+                            f"({capable} capable of {servers} servers)")
+            publish_merged = merged
+        except Exception as e:
+            # Keep negotiating: a bad advert or reply must not leave the choice stuck
+            logger.error(f"Pub/sub encoding check failed: {e}")
+        time.sleep(CODEC_HEARTBEAT_INTERVAL)
+
+# --- SERVER LEASES ---
+# Every server holds server_lease:<id>, renewed every SERVER_LEASE_TTL / 3
+# seconds, and records the sessions it owns in session_owner (user -> id)
+# and server_sessions:<id>. A killed server never runs cleanup_steps, so
+# the live servers reap its sessions once its lease expires.
+def reap_sessions(server_id):
+    """Reaps server_id's sessions if its lease has expired."""
+    total = 0
+    while True:
+        with redis_seconds.labels("reap_sessions").time():
+            left, reaped = state.reap_sessions(server_id, REAP_BATCH)
+        if left < 0:
+            return
+        total += reaped
+        if left == 0:
+            break
+    sessions_reaped.inc(total)
+    if total:
+        logger.info(f"Reaped {total} sessions of server {server_id}, whose lease expired")
+
+def reap_user_steps(server_id, username):
+    """Reaps username's session if server_id's lease has expired. Returns
+    False if the server is alive."""
+    left, reaped = yield call("reap_sessions", "reap_sessions", server_id, REAP_BATCH, username)
+    sessions_reaped.inc(reaped)
+    return left >= 0
 
-# --- REDIS CONNECTION ---
-try:
-    r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
-    r.ping()
-    logger.info(f"Connected to Redis at {REDIS_HOST}:{REDIS_PORT}")
-except redis.ConnectionError:
-    logger.error("Could not connect to Redis. Exiting.")
-    exit(1)
+def reap_dead_servers():
+    for server_id in state.expired_servers():
+        reap_sessions(server_id)
+
+def local_sessions():
+    """(username, room) of every session on this server, either engine."""
+    sessions = local.sessions() + async_local.sessions()
+    return [(username, room) for username, room in sessions if room]
+
+def restore_local_sessions():
+    restored = sum(state.restore_session(INSTANCE_ID, username, room) for username, room in local_sessions())
+    logger.info(f"Restored {restored} sessions")
+
+def maintain_server_lease():
+    """Renews our lease and reaps the sessions of servers whose lease expired."""
+    while True:
+        time.sleep(SERVER_LEASE_TTL / 3)
+        try:
+            if not state.renew_lease(INSTANCE_ID, SERVER_LEASE_TTL):
+                # Stalled past the TTL; our sessions may have been reaped
+                logger.warning("Server lease had expired; registering again")
+                state.register_server(INSTANCE_ID, SERVER_LEASE_TTL)
+                restore_local_sessions()
+            reap_dead_servers()
+        except redis.RedisError as e:
+            logger.error(f"Server lease renewal failed: {e}")
+
+def start_server_lease():
+    state.register_server(INSTANCE_ID, SERVER_LEASE_TTL)
+    threading.Thread(target=maintain_server_lease, daemon=True).start()
+
+# --- RESUME TOKENS ---
+# LOGIN and RESUME reply "AUTH_SUCCESS <token>". resume:<user> holds the id
+# of the user's current token and the room to put them back in.
+def load_resume_secret():
+    """RESUME_SECRET, or a random secret shared by every server through the backend."""
+    secret = os.environ.get("RESUME_SECRET")
+    if not secret:
+        secret = state.shared_secret("resume_secret")
+    return secret.encode()
+
+resume_secret = load_resume_secret()
+
+def resume_room(record, live_room):
+    # A session that was never cleaned up (its server died) still has the
+    # latest room in user_sessions; otherwise use the room saved at cleanup
+    return live_room or record.get("room") or "lobby"
+
+def check_resume_token_steps(token):
+    """Returns (username, room) for a valid, current token. Raises TokenError."""
+    username, token_id = verify_token(resume_secret, token)
+    record, live_room = yield call("resume_lookup", "resume_record", username)
+    if record.get("id") != token_id:
+        raise TokenError("token revoked")
+    return username, resume_room(record, live_room)
+
+def join_announcement(username, room):
+    return f"{username} joined the lobby" if room == "lobby" else f"{username} joined {room}"
+
+# --- ROOM HISTORY ---
+# Room broadcasts are also appended to history:<room>, a stream capped at
+# about HISTORY_MAXLEN entries that expires HISTORY_TTL seconds after its
+# last message. Joining a room replays the last HISTORY_REPLAY messages, and
+# the Redis listener uses the entry ids to recover messages it missed while
+# disconnected.
+
+def channel_room(channel):
+    return channel.split(":", 1)[1]
+
+def stream_id_key(stream_id):
+    ms, seq = stream_id.split("-")
+    return int(ms), int(seq)
+
+def next_stream_id(stream_id):
+    """Smallest id after stream_id, for an exclusive XRANGE start."""
+    ms, seq = stream_id_key(stream_id)
+    return f"{ms}-{seq + 1}"
+
+def first_delivery(last_seen, channel, stream_id):
+    """Records stream_id as the newest relayed on channel. False if it was
+    relayed already (recovered messages overlapping live ones)."""
+    last = last_seen.get(channel)
+    if last is not None and stream_id_key(stream_id) <= stream_id_key(last):
+        return False
+    last_seen[channel] = stream_id
+    return True
+
+def history_contents(payloads):
+    """Message texts of history payloads, in the order given."""
+    contents = []
+    for payload in payloads:
+        try:
+            message = decode_payload(payload)
+            if message.get("type") == "CHAT":
+                expand_chat(message, "BROADCAST")
+            contents.append(message["content"])
+        except (KeyError, ValueError):
+            continue
+    return contents
+
+def history_header(room, count):
+    return f"[SYSTEM] Last {count} messages in {room}:"
+
+def replay_history_steps(table, conn, room):
+    """Sends the room's most recent messages (one XREVRANGE)."""
+    if not (HISTORY_MAXLEN and HISTORY_REPLAY):
+        return
+    payloads = yield call("history_read", "room_history", room, HISTORY_REPLAY)
+    contents = history_contents(payloads)
+    if contents:
+        table.send(conn, history_header(room, len(contents)))
+        for content in contents:
+            table.send(conn, content)
+
+def note_history_positions(channels, last_seen, heads):
+    """Starts tracking newly subscribed room channels at their newest entry."""
+    for channel, head in zip(channels, heads):
+        last_seen[channel] = head or "0-0"
+
+def count_recovered(count):
+    if count:
+        logger.info(f"Recovered {count} room messages missed while the Redis listener was disconnected")
 
 # --- LOCAL STATE ---
-local_clients = {}       # {socket: username}
-local_clients_lock = threading.Lock()
+# Each engine keeps its connections in a ClientTable: `local` for the
+# threaded engine (keyed by socket), `async_local` for the asyncio engine
+# (keyed by StreamWriter).
+class ClientTable:
+    """One engine's connections and the indexes fan-out needs. write_encoded,
+    close_outbound and abort are the engine's outbound I/O. The lock guards
+    what listener dispatch threads read; the asyncio engine only takes it
+    uncontended, and never across an await."""
+
+    def __init__(self, write_encoded, close_outbound, abort):
+        self.write_encoded = write_encoded     # queues an encode_outbound() result
+        self.close_outbound = close_outbound   # the writer flushes what is queued, then closes
+        self.abort = abort                     # the writer drops what is queued and closes
+        self.clients = {}         # {connection: username}
+        self.users = {}           # {username: connection} - reverse index for force logout
+        self.login_acks = {}      # {connection: ack key of the FORCE_LOGOUT its login published}
+        self.resume_ids = {}      # {connection: id of the resume token issued to it}
+        self.rooms = {}           # {room: {connections}} - local room membership index
+        self.client_rooms = {}    # {connection: room}
+        self.follows = {}         # {connection: {publishers}}
+        self.followers = {}       # {publisher: {connections}} - reverse index for PUBSUB fan-out
+        self.decoders = {}        # {connection: FrameDecoder} for clients speaking the framed protocol
+        self.inbox = {}           # {connection: deque of received but unhandled messages}
+        self.last_read = {}       # {connection: time.monotonic() of the last bytes received}
+        self.last_ping = {}       # {connection: time.monotonic() of the last PING sent}
+        self.room_last_seen = {}  # {room channel: id of the newest history entry relayed}
+        self.lock = threading.Lock()
+        # Pub/Sub channels these clients need: {channel: number of local clients using it}
+        self.channel_refs = {}
+        self.channel_refs_lock = threading.Lock()
+        self.channels_changed = threading.Event()   # picked up by the engine's listener
+
+    def send(self, conn, text):
+        """Queues one message, in the wire mode the client negotiated."""
+        self.write_encoded(conn, encode_outbound(text))
+
+    def retain_channels(self, acquire=(), release=()):
+        with self.channel_refs_lock:
+            if update_channel_refs(self.channel_refs, acquire, release):
+                self.channels_changed.set()
+
+    def wanted_channels(self):
+        with self.channel_refs_lock:
+            return set(self.channel_refs)
+
+    def set_follows(self, conn, **changes):
+        with self.lock:
+            added, removed = change_follows(self.follows, self.followers, conn, **changes)
+        self.retain_channels(acquire=[publisher_channel(p) for p in added],
+                             release=[publisher_channel(p) for p in removed])
+
+    def set_room(self, conn, room):
+        with self.lock:
+            old_room = move_in_room_index(self.rooms, self.client_rooms, conn, room)
+        if old_room != room:
+            self.retain_channels(acquire=[room_channel(room)] if room else (),
+                                 release=[room_channel(old_room)] if old_room else ())
+
+    def add_session(self, conn, username, resume_id, ack_key=None):
+        with self.lock:
+            self.clients[conn] = username
+            self.users[username] = conn
+            self.resume_ids[conn] = resume_id
+            if ack_key:
+                self.login_acks[conn] = ack_key
+
+    def sessions(self):
+        """(username, room) of every logged-in connection."""
+        with self.lock:
+            return [(username, self.client_rooms.get(conn)) for conn, username in self.clients.items()]
+
+    def start_wire(self, conn, data):
+        """Sets the wire mode from a connection's first bytes. Clients that open
+        with FRAMED_MAGIC get the length-prefixed protocol; anything else is
+        the legacy text mode, and data already holds the LOGIN/REGISTER line."""
+        self.last_read[conn] = time.monotonic()
+        inbox = self.inbox[conn] = deque()
+        if data.startswith(FRAMED_MAGIC):
+            decoder = self.decoders[conn] = FrameDecoder()
+            decoder.feed(data[len(FRAMED_MAGIC):])
+            collect_frames(decoder, inbox)
+        elif data:
+            inbox.append(data.decode('utf-8'))
+
+    def drop_wire_state(self, conn):
+        self.decoders.pop(conn, None)
+        self.inbox.pop(conn, None)
+        self.last_read.pop(conn, None)
+        self.last_ping.pop(conn, None)
+
+def room_channel(room):
+    return f"room:{room}"
+
+def publisher_channel(publisher):
+    return f"pub:{publisher}"
+
+def move_in_room_index(rooms_index, member_rooms, member, room):
+    """Moves member into room in a room -> members index (room=None removes it).
+    Callers hold whatever lock guards the two dicts. Returns the previous room."""
+    old_room = member_rooms.pop(member, None)
+    if old_room is not None:
+        members = rooms_index.get(old_room)
+        if members is not None:
+            members.discard(member)
+            if not members:
+                del rooms_index[old_room]
+    if room is not None:
+        member_rooms[member] = room
+        rooms_index.setdefault(room, set()).add(member)
+    return old_room
+
+def change_follows(member_follows, followers_index, member, add=(), remove=(), replace=None):
+    """Updates the publishers a member follows and the publisher -> members
+    index with it. `replace` sets the whole set (empty forgets the member).
+    Callers hold whatever lock guards the two dicts. Returns (added, removed)."""
+    old = member_follows.pop(member, set())
+    new = set(replace) if replace is not None else (old | set(add)) - set(remove)
+    if new:
+        member_follows[member] = new
+    for publisher in old - new:
+        followers = followers_index.get(publisher)
+        if followers is not None:
+            followers.discard(member)
+            if not followers:
+                del followers_index[publisher]
+    for publisher in new - old:
+        followers_index.setdefault(publisher, set()).add(member)
+    return new - old, old - new
+
+def update_channel_refs(refs, acquire=(), release=()):
+    """Adjusts channel reference counts.
+    Returns True if a channel was added to or dropped from the wanted set."""
+    changed = False
+    for channel in release:
+        count = refs.get(channel, 0) - 1
+        if count <= 0:
+            refs.pop(channel, None)
+            changed = True
+        else:
+            refs[channel] = count
+    for channel in acquire:
+        count = refs.get(channel, 0) + 1
+        refs[channel] = count
+        if count == 1:
+            changed = True
+    return changed
+
+# --- AUTH WORKER POOL ---
+# bcrypt is deliberately slow. Running it on connection threads lets a login
+# storm starve message fan-out, so hashing and verification go to a bounded
+# process pool. Jobs beyond AUTH_QUEUE_LIMIT are rejected straight away.
+auth_slots = threading.BoundedSemaphore(AUTH_QUEUE_LIMIT)
+auth_stats = {"depth": 0, "completed": 0, "rejected": 0, "latency_sum": 0.0, "latency_max": 0.0}
+auth_stats_lock = threading.Lock()
+
+class AuthBusy(Exception):
+    """Raised when the auth queue is full."""
+
+def start_auth_pool():
+    """Starts the stats thread of the pool fork_auth_workers created."""
+    threading.Thread(target=log_auth_stats, daemon=True).start()
+    logger.info(f"Auth pool started: {AUTH_WORKERS} workers, queue limit {AUTH_QUEUE_LIMIT}")
+
+def submit_auth_job(fn, *args):
+    """Queues a bcrypt call on the pool and returns its Future. Raises AuthBusy when full."""
+    if not auth_slots.acquire(blocking=False):
+        with auth_stats_lock:
+            auth_stats["rejected"] += 1
+        auth_rejected.inc()
+        raise AuthBusy()
+
+    started = time.monotonic()
+    with auth_stats_lock:
+        auth_stats["depth"] += 1
+
+    def on_done(_future):
+        latency = time.monotonic() - started
+        auth_slots.release()
+        auth_job_seconds.observe(latency)
+        with auth_stats_lock:
+            auth_stats["depth"] -= 1
+            auth_stats["completed"] += 1
+            auth_stats["latency_sum"] += latency
+            auth_stats["latency_max"] = max(auth_stats["latency_max"], latency)
+
+    future = auth_pool.submit(fn, *args)
+    future.add_done_callback(on_done)
+    return future
+
+def log_auth_stats():
+    """Logs auth queue depth and latency so the pool can be sized."""
+    while True:
+        time.sleep(AUTH_STATS_INTERVAL)
+        with auth_stats_lock:
+            stats = dict(auth_stats)
+            auth_stats.update(completed=0, rejected=0, latency_sum=0.0, latency_max=0.0)
+        if stats["completed"] or stats["rejected"] or stats["depth"]:
+            avg_ms = stats["latency_sum"] / max(stats["completed"], 1) * 1000
+            logger.info(f"Auth stats: depth={stats['depth']} completed={stats['completed']} "
+                        f"rejected={stats['rejected']} avg={avg_ms:.1f}ms "
+                        f"max={stats['latency_max'] * 1000:.1f}ms")
 
 # --- DB INITIALIZATION ---
 def init_db():
-    """Seeds the Redis database with users if they don't exist."""
-    # Only seed if the 'users' hash doesn't exist to avoid overwriting
-    if not r.exists("users"):
+    """Seeds the user database if it is empty."""
+    # Only seed if there are no users, to avoid overwriting
+    if not state.has_users():
         users = {
             "alice": bcrypt.hashpw("password123".encode(), bcrypt.gensalt()).decode(),
             "bob": bcrypt.hashpw("secret456".encode(), bcrypt.gensalt()).decode(),
             "charlie": bcrypt.hashpw("hello789".encode(), bcrypt.gensalt()).decode()
         }
-        r.hmset("users", users)
-        logger.info("Seeded user database into Redis.")
+        state.add_users(users)
+        logger.info("Seeded user database.")
+
+    backfilled = state.rebuild_room_index()
+    if backfilled:
+        logger.info(f"Backfilled rooms_index with {backfilled} rooms.")
+
+def parse_rooms_page(data):
+    """Page number from '/rooms [page]' (1-based, defaults to 1)."""
+    parts = data.split()
+    if len(parts) > 1 and parts[1].isdigit():
+        return max(int(parts[1]), 1)
+    return 1
+
+def format_rooms_page(entries, page, total):
+    pages = max((total + ROOMS_PAGE_SIZE - 1) // ROOMS_PAGE_SIZE, 1)
+    listing = ', '.join(f"{room} ({int(count)})" for room, count in entries)
+    return f"[SYSTEM] Active Rooms (page {page}/{pages}, {total} total): {listing}"
+
+def sync_subscriptions(pubsub, subscribed, wanted):
+    """Subscribes/unsubscribes pubsub so that `subscribed` matches `wanted`."""
+    to_add = wanted - subscribed
+    to_drop = subscribed - wanted
+    if to_add:
+        pubsub.subscribe(*to_add)
+    if to_drop:
+        pubsub.unsubscribe(*to_drop)
+    subscribed.clear()
+    subscribed.update(wanted)
+
+def observe_pubsub_message(channel, data):
+    pubsub_messages.labels(channel_kind(channel)).inc()
+    if 'ts' in data:   # set by chat_payload; script-published notices have none
+        pubsub_lag_seconds.observe(time.time() - data['ts'])
+
+def open_listener_pubsub():
+    pubsub = state.open_pubsub()
+    pubsub.subscribe('control_channel')
+    return pubsub
+
+def channel_changes_steps(table, subscribed):
+    """The channels table's clients need now. Starts tracking the history of
+    rooms about to be subscribed and forgets those about to be dropped."""
+    table.channels_changed.clear()
+    wanted = table.wanted_channels()
+    rooms = [channel for channel in wanted - subscribed if channel_kind(channel) == "room"]
+    if rooms and HISTORY_MAXLEN:
+        heads = yield call(None, "history_heads", [channel_room(channel) for channel in rooms])
+        note_history_positions(rooms, table.room_last_seen, heads)
+    for channel in subscribed - wanted:
+        table.room_last_seen.pop(channel, None)
+    return wanted
+
+def missed_messages_steps(table, channels):
+    """(channel, stream id, payload) of the room messages published while
+    the listener was disconnected."""
+    rooms = [channel for channel in channels if channel in table.room_last_seen]
+    if not rooms:
+        return []
+    missed = yield call(None, "history_after", [channel_room(channel) for channel in rooms],
+                        [next_stream_id(table.room_last_seen[channel]) for channel in rooms])
+    return [(channel, stream_id, payload)
+            for channel, entries in zip(rooms, missed) for stream_id, payload in entries]
+
+def recover_missed_messages(channels):
+    """Relays room messages published while the listener was disconnected."""
+    missed = run_steps(missed_messages_steps(local, channels))
+    for channel, stream_id, payload in missed:
+        route_message(channel, payload, stream_id)
+    count_recovered(len(missed))
+
+def route_message(channel, raw, stream_id=None):
+    if dispatch_queues:
+        enqueue_dispatch(channel, raw, stream_id)
+    else:
+        dispatch_message(channel, raw, stream_id)
 
 def handle_redis_messages():
-    """Listens for global messages and control commands."""
-    pubsub = r.pubsub()
-    pubsub.subscribe('global_chat', 'control_channel')
+    """Listens for room/publisher messages and control commands.
+
+    Room (room:<name>) and publisher (pub:<user>) channels are only subscribed
+    while at least one local client needs them, so this server never receives
+    traffic for rooms and publishers nobody here cares about. If the
+    connection drops, it reconnects, resubscribes and recovers missed room
+    messages from the history streams.
+    """
+    pubsub = None
+    subscribed = set()
     
-    for message in pubsub.listen():
-        if message['type'] == 'message':
-            try:
-                channel = message['channel']
-                data = json.loads(message['data'])
-                
-                if channel == "control_channel":
-                    handle_control_message(data)
-                elif channel == "global_chat":
-                    handle_chat_message(data)
-            except json.JSONDecodeError:
-                logger.error("Failed to decode Redis message")
-
-def handle_control_message(data):
-    """Handles Force Logout"""
-    if data.get('type') == "FORCE_LOGOUT":
+    while True:
+        try:
+            if pubsub is None:
+                pubsub = open_listener_pubsub()
+                if subscribed:
+                    channels, subscribed = subscribed, set()
+                    sync_subscriptions(pubsub, subscribed, channels)
+                    recover_missed_messages(subscribed)
+
+            # Channel changes are applied here so only this thread touches pubsub
+            if local.channels_changed.is_set():
+                sync_subscriptions(pubsub, subscribed, run_steps(channel_changes_steps(local, subscribed)))
+
+            message = pubsub.get_message(timeout=PUBSUB_POLL_INTERVAL)
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            logger.warning(f"Redis listener disconnected ({e}); reconnecting")
+            pubsub = None
+            time.sleep(PUBSUB_RECONNECT_DELAY)
+            continue
+
+        if message and message['type'] == 'message':
+            route_message(message['channel'].decode(), message['data'])
+
+def handle_local_messages():
+    """Relays what MemoryBackend publishes, as handle_redis_messages does for
+    Redis. Every channel arrives here; fan-out skips those nobody follows."""
+    while True:
+        channel, payload = state.bus.get()
+        route_message(channel, payload)
+
+# --- LISTENER DISPATCH ---
+# The listener only reads from Redis; decoding and fan-out run on
+# DISPATCH_WORKERS threads. Messages are sharded by channel, so everything
+# for one room (room:<name>) or publisher (pub:<user>) is handled in order by
+# one worker. Control messages all go to shard 0 and stay ordered too.
+dispatch_queues = []   # one Queue of (channel, raw payload, stream id) per worker
+
+def dispatch_steps(table, channel, raw, stream_id=None):
+    """Handles one pub/sub message for table's clients. stream_id is given
+    for messages recovered from a history stream."""
+    try:
+        data = decode_payload(raw)
+    except ValueError as e:   # bad JSON, or an envelope version we do not know
+        logger.error(f"Failed to decode Redis message: {e}")
+        return
+    if stream_id:
+        data['id'] = stream_id
+    else:
+        observe_pubsub_message(channel, data)
+
+    if channel == "control_channel":
+        yield from control_message_steps(table, data)
+    elif 'id' not in data or first_delivery(table.room_last_seen, channel, data['id']):
+        if data.get('type') == "CHAT":
+            expand_chat(data, chat_copy_type(channel))
+        handle_chat_message(table, data)
+
+def dispatch_message(channel, raw, stream_id=None):
+    run_steps(dispatch_steps(local, channel, raw, stream_id))
+
+def enqueue_dispatch(channel, raw, stream_id=None):
+    shard = 0 if channel == "control_channel" else hash(channel) % len(dispatch_queues)
+    work = dispatch_queues[shard]
+    try:
+        work.put_nowait((channel, raw, stream_id))
+    except Full:
+        # Backpressure: stop reading from Redis until this shard catches up
+        logger.warning(f"Dispatch shard {shard} backlog full ({DISPATCH_QUEUE_SIZE}); listener waiting")
+        work.put((channel, raw, stream_id))
+
+def dispatch_worker(shard, work):
+    while True:
+        channel, raw, stream_id = work.get()
+        try:
+            dispatch_message(channel, raw, stream_id)
+        except Exception as e:
+            logger.error(f"Dispatch error on shard {shard}: {e}")
+
+def start_dispatch_workers():
+    for shard in range(DISPATCH_WORKERS):
+        work = Queue(maxsize=DISPATCH_QUEUE_SIZE)
+        dispatch_queues.append(work)
+        threading.Thread(target=dispatch_worker, args=(shard, work), daemon=True).start()
+    if DISPATCH_WORKERS:
+        logger.info(f"Listener dispatch: {DISPATCH_WORKERS} workers, {DISPATCH_QUEUE_SIZE} messages per shard")
+
+# --- OUTBOUND QUEUES ---
+# Every connection gets a bounded queue drained by its own writer, so fan-out
+# never blocks on one client's socket. What happens when a queue is full is
+# set by OUTBOUND_POLICY:
+#   drop_oldest - discard the oldest queued message
+#   coalesce    - merge everything queued into one buffer (up to OUTBOUND_MAX_BYTES)
+#   disconnect  - evict the slow consumer
+outbound_queues = {}   # {socket: OutboundQueue}, threaded engine
+outbound_stats = {"dropped": 0, "coalesced": 0, "evicted": 0}
+outbound_stats_lock = threading.Lock()
+
+def count_outbound(stat):
+    with outbound_stats_lock:
+        outbound_stats[stat] += 1
+    outbound_events.labels(stat).inc()
+
+class OutboundQueue:
+    """Bounded per-client queue of encoded messages."""
+
+    def __init__(self, limit=OUTBOUND_QUEUE_SIZE, policy=OUTBOUND_POLICY):
+        self.items = deque()
+        self.limit = limit
+        self.policy = policy
+        self.closed = False
+        self.cond = threading.Condition()   # used by the threaded writer only
+
+    def push(self, data):
+        """Queues data, applying the overflow policy. Not locked.
+        Returns False when the consumer should be disconnected."""
+        if self.closed:
+            return True
+        if len(self.items) >= self.limit:
+            if self.policy == "drop_oldest":
+                self.items.popleft()
+                count_outbound("dropped")
+            elif self.policy == "coalesce":
+                merged = b"".join(self.items)
+                if len(merged) + len(data) > OUTBOUND_MAX_BYTES:
+                    return False
+                self.items.clear()
+                self.items.append(merged)
+                count_outbound("coalesced")
+            else:
+                return False
+        self.items.append(data)
+        return True
+
+    def take_all(self):
+        batch = list(self.items)
+        self.items.clear()
+        return batch
+
+    def put(self, data):
+        with self.cond:
+            was_empty = not self.items
+            accepted = self.push(data)
+            if was_empty:
+                self.cond.notify()   # the writer only blocks on an empty queue
+        return accepted
+
+    def get_batch(self, linger=0):
+        """Blocks until messages are queued, then waits up to `linger` seconds
+        for more to arrive. Returns None once closed and drained."""
+        with self.cond:
+            while not self.items and not self.closed:
+                self.cond.wait()
+            if not self.items:
+                return None
+            deadline = time.monotonic() + linger
+            while not self.closed and len(self.items) < self.limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return self.take_all()
+
+    def close(self, discard=False):
+        with self.cond:
+            self.closed = True
+            if discard:
+                self.items.clear()
+            self.cond.notify()
+
+def hard_close(client_socket):
+    """Shuts the socket down under any blocked recv/send, then closes it."""
+    try:
+        socket.socket.shutdown(client_socket, socket.SHUT_RDWR)
+    except OSError:
+        pass
+    try:
+        client_socket.close()
+    except OSError:
+        pass
+
+def connection_writer(client_socket, queue):
+    """Drains one client's queue. Closing the queue flushes it (or, with
+    discard, drops it) and closes the socket; nothing else closes it."""
+    try:
+        while True:
+            batch = queue.get_batch(OUTBOUND_FLUSH_DELAY)
+            if batch is None:
+                break
+            if client_socket in local.decoders:
+                # One sendall per batch: fewer TLS records and write syscalls
+                client_socket.sendall(batch[0] if len(batch) == 1 else b"".join(batch))
+            else:
+                # Older text clients take each read as one message; each keeps its own record
+                for data in batch:
+                    client_socket.sendall(data)
+    except OSError as e:
+        # Includes SO_SNDTIMEO expiring on a client that stopped reading
+        logger.info(f"Send failed, closing connection: {e}")
+    finally:
+        queue.close(discard=True)
+        hard_close(client_socket)   # also wakes the reader so cleanup runs
+
+def start_writer(client_socket):
+    # A send that cannot make progress for OUTBOUND_SEND_TIMEOUT fails
+    # instead of pinning the writer forever.
+    seconds = int(OUTBOUND_SEND_TIMEOUT)
+    micros = int((OUTBOUND_SEND_TIMEOUT - seconds) * 1_000_000)
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, struct.pack("ll", seconds, micros))
+
+    queue = outbound_queues[client_socket] = OutboundQueue()
+    threading.Thread(target=connection_writer, args=(client_socket, queue), daemon=True).start()
+
+def close_outbound(client_socket):
+    """Lets the writer flush what is queued, then close the socket."""
+    queue = outbound_queues.pop(client_socket, None)
+    if queue:
+        queue.close()
+
+def abort_outbound(client_socket):
+    """Lets the writer drop what is queued and close the socket."""
+    queue = outbound_queues.get(client_socket)
+    if queue:
+        queue.close(discard=True)
+
+def evict_slow_consumer(client_socket, queue):
+    count_outbound("evicted")
+    with local.lock:
+        username = local.clients.get(client_socket)
+    logger.warning(f"Disconnecting slow consumer {username}: outbound queue full ({OUTBOUND_POLICY} policy)")
+    # Only the writer closes the socket, so its fd cannot be closed and
+    # reused under a send in progress. A blocked send gives up after
+    # OUTBOUND_SEND_TIMEOUT.
+    queue.close(discard=True)
+
+def log_outbound_stats():
+    """Logs outbound queue depth and drop counters."""
+    while True:
+        time.sleep(OUTBOUND_STATS_INTERVAL)
+        queues = list(outbound_queues.values()) + [q for q, _ in list(async_outbound.values())]
+        depths = [len(q.items) for q in queues]
+        with outbound_stats_lock:
+            stats = dict(outbound_stats)
+            outbound_stats.update(dropped=0, coalesced=0, evicted=0)
+        logger.info(f"Outbound stats: queues={len(depths)} queued={sum(depths)} "
+                    f"max_depth={max(depths, default=0)} dropped={stats['dropped']} "
+                    f"coalesced={stats['coalesced']} evicted={stats['evicted']}")
+
+# --- WIRE PROTOCOL ---
+def encode_outbound(text):
+    """Serializes a message once for both wire modes: (text bytes, framed bytes).
+    The result is immutable and shared by every recipient of the message.
+    Binary envelopes already carry the content as UTF-8 bytes. Text mode is
+    newline-delimited, so a newline in the message (a chat line, a room
+    name) must not start a line of its own there."""
+    payload = text if isinstance(text, bytes) else text.encode()
+    return payload.replace(LINE_END, b" ") + LINE_END, encode_frame(payload)
+
+def send_encoded(client_socket, wire):
+    """Queues an encode_outbound() result in the wire mode the client negotiated."""
+    queue = outbound_queues.get(client_socket)
+    data = wire[1] if client_socket in local.decoders else wire[0]
+    if queue and not queue.put(data):
+        evict_slow_consumer(client_socket, queue)
+
+def collect_frames(decoder, inbox):
+    for frame_type, payload in decoder.frames():
+        if frame_type == FRAME_TEXT:
+            inbox.append(str(payload, 'utf-8'))
+
+def negotiate_protocol(client_socket):
+    """Reads the first bytes of a connection and sets its wire mode (see ClientTable.start_wire)."""
+    data = client_socket.recv(1024)
+    while data and len(data) < len(FRAMED_MAGIC) and FRAMED_MAGIC.startswith(data):
+        more = client_socket.recv(1024)
+        if not more:
+            break
+        data += more
+    local.start_wire(client_socket, data)
+
+def read_message(client_socket):
+    """Returns the next message from the client, or '' once it disconnects."""
+    inbox = local.inbox.setdefault(client_socket, deque())
+    decoder = local.decoders.get(client_socket)
+    while not inbox:
+        if decoder is None:
+            data = client_socket.recv(1024).decode('utf-8')
+            local.last_read[client_socket] = time.monotonic()
+            return data
+        if decoder.recv_from(client_socket) == 0:
+            return ''
+        local.last_read[client_socket] = time.monotonic()
+        # Pipelined frames from one read are queued and handled in order
+        collect_frames(decoder, inbox)
+    return inbox.popleft()
+
+local = ClientTable(send_encoded, close_outbound, abort_outbound)
+
+# --- CONNECTION LIVENESS ---
+# Every read stamps the connection. A sweeper pings clients that have been
+# silent for PING_INTERVAL and closes connections silent for IDLE_TIMEOUT
+# (READ_TIMEOUT before login), so vanished clients do not keep a thread,
+# a TLS context and a room membership. TCP keepalive catches half-open
+# connections even where pings are disabled.
+PING_WIRE = (PING_LINE.encode() + LINE_END, encode_frame(b"", FRAME_PING))
+
+def set_keepalive(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):   # Linux; other platforms keep the system defaults
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, TCP_KEEPALIVE_IDLE)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, TCP_KEEPALIVE_INTERVAL)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, TCP_KEEPALIVE_COUNT)
+
+def sweep_action(now, read_at, pinged_at, logged_in):
+    """"read" or "idle" to close the connection, "ping", or None."""
+    silent = now - read_at
+    if not logged_in:
+        return "read" if READ_TIMEOUT and silent > READ_TIMEOUT else None
+    if IDLE_TIMEOUT and silent > IDLE_TIMEOUT:
+        return "idle"
+    if PING_INTERVAL and silent > PING_INTERVAL and now - pinged_at > PING_INTERVAL:
+        return "ping"
+    return None
+
+def log_swept(username, reason):
+    connections_swept.labels(reason).inc()
+    session_log.info("Closing silent connection of %s (%s timeout)", username or "unauthenticated client", reason)
+
+def sweep_steps(table):
+    """Pings silent clients and closes the connections that stay silent."""
+    now = time.monotonic()
+    with table.lock:
+        clients = dict(table.clients)
+    for conn, read_at in list(table.last_read.items()):
+        username = clients.get(conn)
+        action = sweep_action(now, read_at, table.last_ping.get(conn, 0), username is not None)
+        if action == "ping":
+            table.last_ping[conn] = now
+            table.write_encoded(conn, PING_WIRE)
+        elif action:
+            log_swept(username, action)
+            table.last_read.pop(conn, None)
+            # Nothing to flush to a dead peer. The writer closes the
+            # connection, which wakes the reader.
+            table.abort(conn)
+            if username:
+                yield from cleanup_steps(table, conn, username)
+
+def sweep_connections():
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        run_steps(sweep_steps(local))
+
+# --- RATE LIMITS ---
+# Token buckets per user for chat lines and for commands, and per room for
+# chat lines sent through this server. A user has one session in the whole
+# cluster, so their buckets limit them everywhere; a room's bucket only
+# covers this server, and RATE_ROOM_CLUSTER adds a bucket for the room on
+# all servers, kept by the publish script and checked in the same call.
+user_message_buckets = BucketTable(RATE_USER_MESSAGES, RATE_USER_MESSAGES_BURST)
+user_command_buckets = BucketTable(RATE_USER_COMMANDS, RATE_USER_COMMANDS_BURST)
+room_message_buckets = BucketTable(RATE_ROOM_MESSAGES, RATE_ROOM_MESSAGES_BURST)
+
+RATE_LIMIT_REPLIES = {
+    "user_messages": "[SYSTEM] Slow down: you are sending messages too fast. Message not sent.",
+    "user_commands": "[SYSTEM] Slow down: too many commands. Command ignored.",
+    "room_messages": "[SYSTEM] This room is too busy right now. Message not sent.",
+    "room_cluster": "[SYSTEM] This room is too busy right now. Message not sent.",
+}
+
+def rate_limit(username, command, room):
+    """The limit a client line exceeds, or None (and it is counted)."""
+    if command != "chat":
+        return None if user_command_buckets.take(username) else "user_commands"
+    if not user_message_buckets.take(username):
+        return "user_messages"
+    if room and not room_message_buckets.take(room):
+        return "room_messages"
+    return None
+
+def throttled_reply(username, limit):
+    rate_limited.labels(limit).inc()
+    command_log.info("%s throttled (%s)", username, limit)
+    return RATE_LIMIT_REPLIES[limit]
+
+def force_logout_message(username):
+    """FORCE_LOGOUT payload and the Redis list the owning server acks on."""
+    ack_key = f"force_ack:{username}:{uuid.uuid4().hex}"
+    return ack_key, json.dumps({"type": "FORCE_LOGOUT", "target": username, "ack": ack_key})
+
+def subscriptions_changed_message(username):
+    """Tells every server to reload username's cached subscriptions from Redis."""
+    return json.dumps({"type": "SUBSCRIPTIONS_CHANGED", "user": username})
+
+def control_message_steps(table, data):
+    """Handles Force Logout and subscription cache invalidation"""
+    if data.get('type') == "SUBSCRIPTIONS_CHANGED":
+        username = data.get('user')
+        with table.lock:
+            conn = table.users.get(username)
+        if conn:
+            follows = yield call(None, "follows", username)
+            with table.lock:
+                if table.users.get(username) is not conn:
+                    return   # logged out meanwhile; cleanup already dropped its follows
+                added, removed = change_follows(table.follows, table.followers, conn, replace=follows)
+            table.retain_channels(acquire=[publisher_channel(p) for p in added],
+                                  release=[publisher_channel(p) for p in removed])
+
+    elif data.get('type') == "FORCE_LOGOUT":
         target_user = data.get('target')
-        target_socket = None
         
-        with local_clients_lock:
-            for sock, user in local_clients.items():
-                if user == target_user:
-                    target_socket = sock
-                    break
+        with table.lock:
+            conn = table.users.get(target_user)
+            # Our own listener can see the message after the new login has
+            # registered; that login must not evict itself.
+            if conn is not None and table.login_acks.get(conn) == data.get('ack'):
+                conn = None
         
-        if target_socket:
+        if conn:
             try:
-                target_socket.send("FORCED_LOGOUT: Logged in from another location.".encode())
-                target_socket.close() # This triggers exception in handle_client -> cleanup
-                logger.info(f"Force logged out local user: {target_user}")
+                table.send(conn, "FORCED_LOGOUT: Logged in from another location.")
             except Exception as e:
-                logger.error(f"Error closing socket for {target_user}: {e}")
+                logger.error(f"Error notifying {target_user} of force logout: {e}")
+            # Evict here rather than in the connection's handler so the
+            # session is gone from Redis before we ack and the new login takes over.
+            yield from cleanup_steps(table, conn, target_user)
+            logger.info(f"Force logged out local user: {target_user}")
+            if data.get('ack'):
+                yield call(None, "ack", data['ack'])
 
-def handle_chat_message(data):
-    """Relays global messages to local clients."""
+def handle_chat_message(table, data):
+    """Relays global messages to table's clients."""
+    started = time.perf_counter()
     msg_type = data.get('type')
     sender = data.get('sender')
     content = data.get('content')
     room = data.get('room')
 
-    with local_clients_lock:
-        active_sockets = list(local_clients.items())
+    with table.lock:
+        # Only connections in the target room / following the sender, no
+        # Redis lookups per recipient
+        if msg_type == "BROADCAST":
+            targets = [(conn, table.clients.get(conn)) for conn in table.rooms.get(room, ())]
+        else:
+            targets = [(conn, table.clients.get(conn)) for conn in table.followers.get(sender, ())]
+
+    wire = encode_outbound(content)   # encoded once, shared by all recipients
+    recipients = 0
 
-    for sock, username in active_sockets:
+    for conn, username in targets:
         if username == sender: continue
 
         try:
-            should_send = False
-            # Room Broadcast
-            if msg_type == "BROADCAST":
-                # Check user's room in Redis to ensure consistency
-                user_room = r.hget("user_sessions", username)
-                if user_room == room:
-                    should_send = True
-            
-            # Pub/Sub
-            elif msg_type == "PUBSUB":
-                if r.sismember(f"subscriptions:{sender}", username):
-                    should_send = True
-
-            if should_send:
-                sock.send(content.encode())
+            # Queued for the connection's writer; never waits on a slow reader
+            table.write_encoded(conn, wire)
+            recipients += 1
         except Exception:
-            pass # Socket might be closed, cleanup handles this
+            pass # Connection might be closed, cleanup handles this
+
+    fanout_recipients.labels(msg_type).inc(recipients)
+    fanout_seconds.labels(msg_type).observe(time.perf_counter() - started)
 
-def handle_registration(client_socket, username, password):
+def registration_steps(table, conn, username, password):
     """
-    Registers a new user in Redis.
+    Registers a new user in the state backend.
     """
     try:
         # Check if username already exists
-        if r.hexists("users", username):
-            client_socket.send("REGISTER_FAILED: Username already exists.".encode())
+        taken = (yield call(None, "password_hash", username)) is not None
+        if not taken:
+            # Hash password and store it, unless the name was taken meanwhile
+            hashed_password = (yield auth_job(bcrypt.hashpw, password.encode(), bcrypt.gensalt())).decode()
+            taken = not (yield call(None, "add_user", username, hashed_password))
+        if taken:
+            table.send(conn, "REGISTER_FAILED: Username already exists.")
             logger.info(f"Registration failed for {username} - already exists")
             return False
         
-        # Hash password and store in Redis
-        hashed_password = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
-        r.hset("users", username, hashed_password)
-        
-        client_socket.send("REGISTER_SUCCESS".encode())
+        table.send(conn, "REGISTER_SUCCESS")
         logger.info(f"New user registered: {username}")
         return True
+
+    except AuthBusy:
+        logger.warning(f"Auth queue full, rejected registration for {username}")
+        table.send(conn, AUTH_BUSY_REPLY)
+        return False
         
     except Exception as e:
         logger.error(f"Registration error: {e}")
-        client_socket.send("REGISTER_FAILED: Server error.".encode())
+        table.send(conn, "REGISTER_FAILED: Server error.")
         return False
 
-def handle_authentication(client_socket):
+REGISTERED = "registered"   # authentication_steps result: a LOGIN comes next
+
+def authentication_steps(table, conn, line):
     """
-    Authenticates against Redis and handles Force Logout.
-    Also supports user registration.
+    Authenticates one LOGIN, RESUME or REGISTER line against the state
+    backend and handles Force Logout. Returns (username, room), REGISTERED
+    or None.
     """
     try:
-        data = client_socket.recv(1024).decode('utf-8').strip().split()
+        data = line.strip().split()
         
         # Handle REGISTER command
         if len(data) == 3 and data[0] == "REGISTER":
-            username = data[1]
-            password = data[2]
-            
-            if handle_registration(client_socket, username, password):
-                # After successful registration, wait for login
-                return handle_authentication(client_socket)
-            else:
-                return None
+            registered = yield from registration_steps(table, conn, data[1], data[2])
+            # After successful registration, wait for login
+            return REGISTERED if registered else None
         
         # Handle LOGIN command
         elif len(data) == 3 and data[0] == "LOGIN":
             username = data[1]
             password = data[2]
 
-            # 1. Fetch hash from Redis
-            stored_hash = r.hget("users", username)
+            # 1. Fetch hash
+            stored_hash = yield call("auth_lookup", "password_hash", username)
             
-            if stored_hash and bcrypt.checkpw(password.encode(), stored_hash.encode()):
-                
-                # 2. Check for existing session (Duplicate Login Policy)
-                if r.hexists("user_sessions", username):
-                    logger.info(f"Duplicate login for {username}. Forcing logout.")
-                    r.publish("control_channel", json.dumps({
-                        "type": "FORCE_LOGOUT", 
-                        "target": username
-                    }))
-                    # Small sleep to allow the other server to close the socket
-                    time.sleep(0.5)
-
-                # 3. Register new session
-                r.hset("user_sessions", username, "lobby")
-                client_socket.send("AUTH_SUCCESS".encode())
-                logger.info(f"User {username} logged in.")
-                return username
+            if stored_hash and (yield auth_job(bcrypt.checkpw, password.encode(), stored_hash.encode())):
+                session_log.info("User %s logged in.", username)
+                return (yield from start_session_steps(table, conn, username, "lobby"))
             
-            client_socket.send("AUTH_FAILED: Invalid credentials.".encode())
+            table.send(conn, "AUTH_FAILED: Invalid credentials.")
+
+        # Handle RESUME command (token from an earlier AUTH_SUCCESS, no bcrypt)
+        elif len(data) == 2 and data[0] == "RESUME":
+            try:
+                username, room = yield from check_resume_token_steps(data[1])
+            except TokenError as e:
+                resumes.labels("rejected").inc()
+                session_log.info("Resume rejected: %s", e)
+                table.send(conn, "RESUME_FAILED: Invalid or expired token.")
+                return None
+            resumes.labels("accepted").inc()
+            session_log.info("User %s resumed their session.", username)
+            return (yield from start_session_steps(table, conn, username, room))
+    except AuthBusy:
+        logger.warning("Auth queue full, rejected login")
+        table.send(conn, AUTH_BUSY_REPLY)
     except Exception as e:
         logger.error(f"Auth error: {e}")
     return None
 
-def handle_client(client_socket, addr):
-    username = handle_authentication(client_socket)
-    if not username:
-        client_socket.close()
-        return
+def start_session_steps(table, conn, username, room):
+    """
+    Registers an authenticated client, evicting any older session of the
+    same user, and sends AUTH_SUCCESS with a new resume token.
+    Returns (username, room).
+    """
+    # Check for existing session (Duplicate Login Policy)
+    ack_key = None
+    exists, owner = yield call("session_check", "session_holder", username)
+    if exists and owner and (yield from reap_user_steps(owner, username)):
+        session_log.info("Took over %s's session from dead server %s", username, owner)
+    elif exists:
+        logger.info(f"Duplicate login for {username}. Forcing logout.")
+        ack_key, message = force_logout_message(username)
+        yield call(None, "publish", "control_channel", message)
+        # Wait for the owning server to confirm the old session is closed
+        if not (yield call(None, "wait_ack", ack_key, FORCE_LOGOUT_TIMEOUT)):
+            logger.warning(f"No force logout ack for {username}; treating old session as stale.")
 
-    with local_clients_lock:
-        local_clients[client_socket] = username
+    # Register new session; the new resume token revokes the previous one
+    token, token_id = issue_token(resume_secret, username, RESUME_TOKEN_TTL)
+    yield call("resume_token", "store_resume_token", username, token_id, room, RESUME_TOKEN_TTL)
+    table.add_session(conn, username, token_id, ack_key)
+    yield call(None, "register_session", username, room, INSTANCE_ID)
+    table.send(conn, f"AUTH_SUCCESS {token}")
+    return username, room
 
-    # Initial join to lobby
-    r.sadd("room:lobby", username)
-    logger.info(f"{username} joined the lobby") # log for initial join
-    publish_message("BROADCAST", username, f"{username} joined the lobby", room="lobby")
+def enter_room_steps(table, conn, username, room):
+    """Puts a new session in the lobby, or in its previous room on RESUME."""
+    follows = yield call(None, "follows", username)
+    table.set_follows(conn, replace=follows)
+    table.set_room(conn, room)
 
-    try:
-        while True:
-            data = client_socket.recv(1024).decode('utf-8')
-            if not data: break
-            
-            # --- COMMANDS ---
-            if data.startswith("/join "):
-                new_room = data.split(" ")[1]
-                switch_room(client_socket, username, new_room)
-            
-            elif data.startswith("/leave"):
-                switch_room(client_socket, username, "lobby")
-
-            elif data == "/rooms":
-                keys = r.keys("room:*")
-                room_names = [k.split(":")[1] for k in keys]
-                logger.info(f"{username} requested active rooms list")
-                client_socket.send(f"[SYSTEM] Active Rooms: {', '.join(room_names)}".encode())
-
-            elif data.startswith("/subscribe "):
-                target = data.split(" ")[1]
-                r.sadd(f"subscriptions:{target}", username)
-                logger.info(f"{username} subscribed to {target}")
-                client_socket.send(f"[SYSTEM] Subscribed to {target}".encode())
-            
-            elif data.startswith("/unsubscribe "):
-                target = data.split(" ")[1]
-                r.srem(f"subscriptions:{target}", username)
-                logger.info(f"{username} unsubscribed from {target}")
-                client_socket.send(f"[SYSTEM] Unsubscribed from {target}".encode())
+    # One script: room set, registry and announcement
+    yield call("enter_room", "enter_room", username, room, join_announcement(username, room))
+    session_log.info("%s joined %s", username, room) # log for initial join
+    yield from replay_history_steps(table, conn, room)
 
-            # --- MESSAGING ---
-            else:
-                current_room = r.hget("user_sessions", username)
-                if current_room:
-                    logger.info(f"[{current_room}] {username}: {data}")
-                    publish_message("BROADCAST", username, f"[{current_room}] {username}: {data}", room=current_room)
-                    publish_message("PUBSUB", username, f"[PUB-SUB] {username}: {data}")
+def command_steps(table, conn, username, data):
+    """Handles one line from a logged-in client: a command or a chat line."""
+    if data == PONG_LINE:
+        return   # text-mode ping answer; the read already counted
+    started = time.perf_counter()
+    command = command_name(data)
+    limit = rate_limit(username, command, table.client_rooms.get(conn))
+    if limit:
+        table.send(conn, throttled_reply(username, limit))
+    
+    # --- COMMANDS ---
+    elif data.startswith("/join "):
+        new_room = data.split(" ")[1]
+        yield from switch_room_steps(table, conn, username, new_room)
+    
+    elif data.startswith("/leave"):
+        yield from switch_room_steps(table, conn, username, "lobby")
 
-    except (ConnectionResetError, ConnectionAbortedError):
-        logger.info(f"Client {username} disconnected unexpectedly.")
-    finally:
-        cleanup_client(client_socket, username)
+    elif data == "/rooms" or data.startswith("/rooms "):
+        # Busiest rooms first, O(log n + page size)
+        page = parse_rooms_page(data)
+        start = (page - 1) * ROOMS_PAGE_SIZE
+        entries, total = yield call("rooms_page", "rooms_page", start, ROOMS_PAGE_SIZE)
+        command_log.info("%s requested active rooms list", username)
+        table.send(conn, format_rooms_page(entries, page, total))
 
-def switch_room(client_socket, username, new_room):
-    old_room = r.hget("user_sessions", username)
+    elif data.startswith("/subscribe "):
+        target = data.split(" ")[1]
+        yield call("subscribe", "follow", username, target, subscriptions_changed_message(username))
+        table.set_follows(conn, add=[target])
+        command_log.info("%s subscribed to %s", username, target)
+        table.send(conn, f"[SYSTEM] Subscribed to {target}")
     
-    # Update Redis
-    if old_room:
-        r.srem(f"room:{old_room}", username) # Correct use of srem
-        publish_message("BROADCAST", username, f"{username} left {old_room}", room=old_room)
-    
-    r.sadd(f"room:{new_room}", username)
-    r.hset("user_sessions", username, new_room)
+    elif data.startswith("/unsubscribe "):
+        target = data.split(" ")[1]
+        yield call("subscribe", "unfollow", username, target, subscriptions_changed_message(username))
+        table.set_follows(conn, remove=[target])
+        command_log.info("%s unsubscribed from %s", username, target)
+        table.send(conn, f"[SYSTEM] Unsubscribed from {target}")
 
-    logger.info(f"{username} switched room from {old_room} to {new_room}")
+    # --- MESSAGING ---
+    else:
+        # Our own copy of the room, kept by switch_room_steps; Redis is
+        # only written when it changes
+        current_room = table.client_rooms.get(conn)
+        if current_room:
+            message_log.info("[%s] %s: %s", current_room, username, data)
+            if not (yield from publish_chat_steps(username, current_room, data)):
+                table.send(conn, throttled_reply(username, "room_cluster"))
 
-    client_socket.send(f"[SYSTEM] Joined room: {new_room}".encode())
-    publish_message("BROADCAST", username, f"{username} joined {new_room}", room=new_room)
+    command_seconds.labels(command).observe(time.perf_counter() - started)
 
-def publish_message(msg_type, sender, content, room=None):
-    message = {"type": msg_type, "sender": sender, "content": content, "room": room}
-    r.publish("global_chat", json.dumps(message))
+def switch_room_steps(table, conn, username, new_room):
+    # Update the backend and announce leave/join atomically
+    old_room = yield call("switch_room", "switch_room", username, new_room)
+    table.set_room(conn, new_room)
 
-def cleanup_client(client_socket, username):
-    """Removes user from Redis and Local state."""
-    with local_clients_lock:
-        if client_socket in local_clients:
-            local_clients.pop(client_socket)
+    command_log.info("%s switched room from %s to %s", username, old_room, new_room)
 
-    # Redis Cleanup
-    if r.hexists("user_sessions", username):
-        current_room = r.hget("user_sessions", username)
-        r.srem(f"room:{current_room}", username) # Remove from set
-        r.hdel("user_sessions", username)        # Remove session
-        
-        publish_message("BROADCAST", username, f"{username} left the chat", room=current_room)
-        logger.info(f"Cleaned up session for {username}")
+    table.send(conn, f"[SYSTEM] Joined room: {new_room}")
+    yield from replay_history_steps(table, conn, new_room)
+
+def chat_payload(msg_type, sender, content, room=None, history=False):
+    # ts lets receiving servers measure pub/sub lag. history=True marks an
+    # envelope for PUBLISH_ROOM_LUA, which appends the stream id to it.
+    if publish_binary:
+        return encode_envelope(msg_type, sender, content, room, ts=time.time(), stream_id_follows=history)
+    return json.dumps({"type": msg_type, "sender": sender, "content": content, "room": room,
+                       "ts": time.time()})
+
+def publish_chat_args(sender, room, text):
+    """state.publish_room arguments for a chat line: the merged CHAT message,
+    or the BROADCAST and PUBSUB copies while an older server is subscribed."""
+    history = bool(HISTORY_MAXLEN)
+    if publish_merged:
+        payload = chat_payload("CHAT", sender, text, room, history=history)
+        followers_payload = ""
+    else:
+        payload = chat_payload("BROADCAST", sender, f"[{room}] {sender}: {text}", room, history=history)
+        followers_payload = chat_payload("PUBSUB", sender, f"[PUB-SUB] {sender}: {text}")
+    return room, room_channel(room), payload, publisher_channel(sender), followers_payload
+
+def chat_copy_type(channel):
+    return "BROADCAST" if channel_kind(channel) == "room" else "PUBSUB"
+
+def expand_chat(data, msg_type):
+    """Turns a received CHAT message into its BROADCAST or PUBSUB copy."""
+    sender = data['sender']
+    prefix = f"[{data['room']}] {sender}: " if msg_type == "BROADCAST" else f"[PUB-SUB] {sender}: "
+    text = data['content']
+    data['type'] = msg_type
+    data['content'] = prefix.encode() + text if isinstance(text, bytes) else prefix + text
+
+def publish_chat_steps(sender, room, text):
+    """Publishes a chat line to the room, its history and the sender's
+    followers: one script call. False if the room's RATE_ROOM_CLUSTER bucket is empty."""
+    return (yield call("publish", "publish_room", *publish_chat_args(sender, room, text),
+                       RATE_ROOM_CLUSTER, RATE_ROOM_CLUSTER_BURST))
+
+def cleanup_steps(table, conn, username):
+    """Removes user from the backend and local state. Safe to run more than once."""
+    with table.lock:
+        owned = table.clients.pop(conn, None) is not None
+        if table.users.get(username) is conn:
+            del table.users[username]
+        table.login_acks.pop(conn, None)
+        resume_id = table.resume_ids.pop(conn, "")
+    table.set_follows(conn, replace=())
+    table.set_room(conn, None)
+    table.drop_wire_state(conn)
 
     try:
-        client_socket.close()
-    except:
-        pass
+        # Backend cleanup (room set, session and "left the chat" in one script).
+        # Only the first run for a connection does this, so a late cleanup
+        # cannot delete the session of a newer login that took over.
+        if owned:
+            owned = yield call("cleanup_session", "end_session", username, resume_id, INSTANCE_ID)
+        if owned:
+            session_log.info("Cleaned up session for %s", username)
+    finally:
+        # The writer flushes anything still queued (e.g. FORCED_LOGOUT) and closes
+        table.close_outbound(conn)
+
+def handle_authentication(client_socket):
+    """Reads LOGIN, RESUME, or REGISTER and then LOGIN. Returns (username, room) or None."""
+    while True:
+        try:
+            line = read_message(client_socket)
+        except Exception as e:
+            logger.error(f"Auth error: {e}")
+            return None
+        session = run_steps(authentication_steps(local, client_socket, line))
+        if session is not REGISTERED:
+            return session
+
+def handle_client(client_socket, addr):
+    connections_total.inc()
+    local.last_read[client_socket] = time.monotonic()
+    start_writer(client_socket)
+    try:
+        negotiate_protocol(client_socket)
+    except (OSError, UnicodeDecodeError) as e:
+        logger.error(f"Handshake error from {addr}: {e}")
+
+    started = time.perf_counter()
+    session = handle_authentication(client_socket)
+    auth_seconds.labels("success" if session else "failed").observe(time.perf_counter() - started)
+    if not session:
+        local.drop_wire_state(client_socket)
+        close_outbound(client_socket)
+        return
+    username, room = session
+
+    try:
+        run_steps(enter_room_steps(local, client_socket, username, room))
+        while True:
+            data = read_message(client_socket)
+            if not data: break
+            run_steps(command_steps(local, client_socket, username, data))
+
+    except (ConnectionResetError, ConnectionAbortedError):
+        session_log.info("Client %s disconnected unexpectedly.", username)
+    except OSError:
+        session_log.info("Connection for %s was closed.", username) # e.g. force logout
+    except ProtocolError as e:
+        logger.info(f"Client {username} sent a bad frame: {e}")
+    except UnicodeDecodeError as e:
+        logger.info(f"Client {username} sent invalid UTF-8: {e}")
+    finally:
+        run_steps(cleanup_steps(local, client_socket, username))
+
+def create_ssl_context():
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile="server.crt", keyfile="server.key")
+    # Tickets let a reconnecting client skip the certificate exchange and key
+    # agreement. Ticket keys belong to this context, so they only resume on
+    # the process that issued them.
+    context.num_tickets = TLS_SESSION_TICKETS
+    return context
+
+handshake_slots = threading.BoundedSemaphore(TLS_HANDSHAKE_CONCURRENCY)
+
+def finish_handshake(secure_sock):
+    """Runs the TLS handshake with TLS_HANDSHAKE_TIMEOUT as the deadline for
+    all of it, not for each read, so a client sending a byte at a time
+    cannot keep its handshake slot. Raises socket.timeout past the deadline."""
+    deadline = time.monotonic() + TLS_HANDSHAKE_TIMEOUT
+    poller = select.poll()
+    poller.register(secure_sock, select.POLLIN)
+    secure_sock.setblocking(False)
+    while True:
+        try:
+            secure_sock.do_handshake()
+            break
+        except ssl.SSLWantReadError:
+            poller.modify(secure_sock, select.POLLIN)
+        except ssl.SSLWantWriteError:
+            poller.modify(secure_sock, select.POLLOUT)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not poller.poll(remaining * 1000):
+            raise socket.timeout("handshake timed out")
+    secure_sock.setblocking(True)
+
+def handshake_and_serve(secure_sock, addr):
+    """Finishes the TLS handshake on the connection's own thread, then serves it."""
+    started = time.perf_counter()
+    try:
+        finish_handshake(secure_sock)
+    except OSError as e:   # includes ssl.SSLError and the timeout
+        result = "timeout" if isinstance(e, socket.timeout) else "failed"
+        tls_handshakes.labels(result).inc()
+        session_log.info("TLS handshake %s from %s: %s", result, addr, e)
+        secure_sock.close()
+        return
+    finally:
+        handshake_slots.release()
+    kind = "resumed" if secure_sock.session_reused else "full"
+    tls_handshakes.labels(kind).inc()
+    tls_handshake_seconds.labels(kind).observe(time.perf_counter() - started)
+    handle_client(secure_sock, addr)
 
 def start_server():
     init_db() # Seed users
+    start_auth_pool()
+    threading.Thread(target=log_outbound_stats, daemon=True).start()
+    threading.Thread(target=log_dropped_records, daemon=True).start()
+    start_metrics()
     
-    # Start Redis Listener
-    threading.Thread(target=handle_redis_messages, daemon=True).start()
+    # Start Redis Listener (or the in-memory bus's)
+    start_dispatch_workers()
+    if state.clustered:
+        threading.Thread(target=handle_redis_messages, daemon=True).start()
+        threading.Thread(target=negotiate_pubsub_encoding, daemon=True).start()
+        start_server_lease()
+    else:
+        threading.Thread(target=handle_local_messages, daemon=True).start()
+    threading.Thread(target=sweep_connections, daemon=True).start()
 
     # SSL Setup
-    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-    context.load_cert_chain(certfile="server.crt", keyfile="server.key")
+    context = ssl_context or create_ssl_context()
 
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if SERVER_WORKERS > 1:
+        # Every worker binds its own socket; the kernel spreads new connections across them
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server_socket.bind((HOST, PORT))
     server_socket.listen()
 
@@ -309,10 +1602,395 @@ def start_server():
     while True:
         try:
             client, addr = server_socket.accept()
-            secure_sock = context.wrap_socket(client, server_side=True)
-            threading.Thread(target=handle_client, args=(secure_sock, addr)).start()
+            set_keepalive(client)
+            # Only the cheap wrap happens here; the handshake runs on the
+            # client's thread. Past the cap, new connections wait in the
+            # listen backlog until a handshake finishes or times out.
+            handshake_slots.acquire()
+            try:
+                secure_sock = context.wrap_socket(client, server_side=True, do_handshake_on_connect=False)
+                threading.Thread(target=handshake_and_serve, args=(secure_sock, addr)).start()
+            except Exception:
+                handshake_slots.release()
+                client.close()
+                raise
         except Exception as e:
             logger.error(f"Accept error: {e}")
 
+# --- ASYNCIO ENGINE (SERVER_MODE=asyncio) ---
+# Same handshake, commands and Redis schema as the threaded server above, but
+# every connection is a coroutine on one event loop instead of an OS thread.
+# Only the I/O lives here; the rest runs the shared steps with async_run_steps.
+async_outbound = {}       # {StreamWriter: (OutboundQueue, asyncio.Event)}
+
+async def async_connection_writer(writer, queue, wakeup):
+    """Drains one client's OutboundQueue into its transport."""
+    try:
+        while True:
+            await wakeup.wait()
+            if OUTBOUND_FLUSH_DELAY and not queue.closed:
+                await asyncio.sleep(OUTBOUND_FLUSH_DELAY)   # let a batch build up
+            wakeup.clear()
+            batch = queue.take_all()
+            if writer in async_local.decoders:
+                writer.write(b"".join(batch))
+            else:
+                for data in batch:   # text mode: one TLS record per message
+                    writer.write(data)
+            await asyncio.wait_for(writer.drain(), OUTBOUND_SEND_TIMEOUT)
+            if queue.closed and not queue.items:
+                break
+    except (OSError, asyncio.TimeoutError) as e:
+        logger.info(f"Send failed, closing connection: {e!r}")
+        writer.transport.abort()
+    finally:
+        queue.close(discard=True)
+        writer.close()
+
+def async_start_writer(writer):
+    queue, wakeup = OutboundQueue(), asyncio.Event()
+    async_outbound[writer] = (queue, wakeup)
+    asyncio.create_task(async_connection_writer(writer, queue, wakeup))
+
+def async_close_outbound(writer):
+    entry = async_outbound.pop(writer, None)
+    if entry:
+        queue, wakeup = entry
+        queue.closed = True
+        wakeup.set()
+    else:
+        writer.close()
+
+def async_abort(writer):
+    """Drops what is queued and closes the transport at once."""
+    entry = async_outbound.get(writer)
+    if entry:
+        queue, wakeup = entry
+        queue.close(discard=True)
+        wakeup.set()
+    writer.transport.abort()
+
+def async_write_encoded(writer, wire):
+    """Queues an encode_outbound() result in the wire mode the client negotiated."""
+    entry = async_outbound.get(writer)
+    if not entry or writer.is_closing():
+        return
+    queue, wakeup = entry
+    data = wire[1] if writer in async_local.decoders else wire[0]
+    if queue.push(data):
+        wakeup.set()
+    else:
+        count_outbound("evicted")
+        logger.warning(f"Disconnecting slow consumer {async_local.clients.get(writer)}: "
+                       f"outbound queue full ({OUTBOUND_POLICY} policy)")
+        async_abort(writer)
+
+async_local = ClientTable(async_write_encoded, async_close_outbound, async_abort)
+
+async def async_negotiate_protocol(reader, writer):
+    """Picks framed or text mode from the first bytes, as negotiate_protocol does."""
+    data = await reader.read(1024)
+    while data and len(data) < len(FRAMED_MAGIC) and FRAMED_MAGIC.startswith(data):
+        more = await reader.read(1024)
+        if not more:
+            break
+        data += more
+    async_local.start_wire(writer, data)
+
+async def async_read_message(reader, writer):
+    """Returns the next message from the client, or '' once it disconnects."""
+    inbox = async_local.inbox.setdefault(writer, deque())
+    decoder = async_local.decoders.get(writer)
+    while not inbox:
+        if decoder is None:
+            data = (await reader.read(1024)).decode('utf-8')
+            async_local.last_read[writer] = time.monotonic()
+            return data
+        data = await reader.read(65536)
+        if not data:
+            return ''
+        async_local.last_read[writer] = time.monotonic()
+        decoder.feed(data)
+        collect_frames(decoder, inbox)
+    return inbox.popleft()
+
+async def async_sweep_connections():
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        await async_run_steps(sweep_steps(async_local))
+
+async def async_recover_missed_messages(channels):
+    missed = await async_run_steps(missed_messages_steps(async_local, channels))
+    for channel, stream_id, payload in missed:
+        await async_run_steps(dispatch_steps(async_local, channel, payload, stream_id))
+    count_recovered(len(missed))
+
+async def async_sync_subscriptions(pubsub, subscribed, wanted):
+    to_add = wanted - subscribed
+    to_drop = subscribed - wanted
+    if to_add:
+        await pubsub.subscribe(*to_add)
+    if to_drop:
+        await pubsub.unsubscribe(*to_drop)
+    subscribed.clear()
+    subscribed.update(wanted)
+
+async def async_handle_redis_messages():
+    """Listens for room/publisher messages and control commands, reconnecting
+    and recovering missed room messages as handle_redis_messages does."""
+    pubsub = None
+    subscribed = set()
+
+    while True:
+        try:
+            if pubsub is None:
+                pubsub = state.async_open_pubsub()
+                await pubsub.subscribe('control_channel')
+                if subscribed:
+                    channels, subscribed = subscribed, set()
+                    await async_sync_subscriptions(pubsub, subscribed, channels)
+                    await async_recover_missed_messages(subscribed)
+
+            if async_local.channels_changed.is_set():
+                wanted = await async_run_steps(channel_changes_steps(async_local, subscribed))
+                await async_sync_subscriptions(pubsub, subscribed, wanted)
+
+            message = await pubsub.get_message(timeout=PUBSUB_POLL_INTERVAL)
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            logger.warning(f"Redis listener disconnected ({e}); reconnecting")
+            pubsub = None
+            await asyncio.sleep(PUBSUB_RECONNECT_DELAY)
+            continue
+
+        if message and message['type'] == 'message':
+            await async_run_steps(dispatch_steps(async_local, message['channel'].decode(), message['data']))
+
+async def async_handle_local_messages():
+    """Asyncio version of handle_local_messages."""
+    loop = asyncio.get_running_loop()
+    published = asyncio.Event()
+    state.on_publish = lambda: loop.call_soon_threadsafe(published.set)
+    while True:
+        await published.wait()
+        published.clear()
+        while not state.bus.empty():
+            channel, payload = state.bus.get_nowait()
+            await async_run_steps(dispatch_steps(async_local, channel, payload))
+
+async def async_handle_authentication(reader, writer):
+    """Asyncio version of handle_authentication."""
+    while True:
+        try:
+            line = await async_read_message(reader, writer)
+        except Exception as e:
+            logger.error(f"Auth error: {e}")
+            return None
+        session = await async_run_steps(authentication_steps(async_local, writer, line))
+        if session is not REGISTERED:
+            return session
+
+async_ssl_context = None
+async_handshake_slots = None   # asyncio.Semaphore(TLS_HANDSHAKE_CONCURRENCY), made on the event loop
+
+async def async_start_tls(reader, writer):
+    """Runs the TLS handshake of an accepted connection, at most
+    TLS_HANDSHAKE_CONCURRENCY at a time and each within TLS_HANDSHAKE_TIMEOUT.
+    Returns the (reader, writer) to use from then on, or None."""
+    async with async_handshake_slots:
+        started = time.perf_counter()
+        try:
+            if hasattr(writer, "start_tls"):   # Python 3.11+
+                await writer.start_tls(async_ssl_context, ssl_handshake_timeout=TLS_HANDSHAKE_TIMEOUT)
+            else:
+                loop = asyncio.get_running_loop()
+                reader = asyncio.StreamReader()
+                protocol = asyncio.StreamReaderProtocol(reader)
+                transport = await loop.start_tls(writer.transport, protocol, async_ssl_context, server_side=True,
+                                                 ssl_handshake_timeout=TLS_HANDSHAKE_TIMEOUT)
+                protocol.connection_made(transport)   # start_tls leaves this to the caller
+                writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+        except (OSError, asyncio.TimeoutError) as e:   # includes ssl.SSLError
+            # asyncio aborts a handshake still running at ssl_handshake_timeout
+            result = "timeout" if isinstance(e, (ConnectionAbortedError, asyncio.TimeoutError)) else "failed"
+            tls_handshakes.labels(result).inc()
+            session_log.info("TLS handshake %s from %s: %s", result, writer.get_extra_info("peername"), e)
+            writer.transport.abort()
+            return None
+    kind = "resumed" if writer.get_extra_info("ssl_object").session_reused else "full"
+    tls_handshakes.labels(kind).inc()
+    tls_handshake_seconds.labels(kind).observe(time.perf_counter() - started)
+    return reader, writer
+
+async def async_handle_client(reader, writer):
+    # The ClientHello is for the TLS layer; keep the plain stream from reading it
+    writer.transport.pause_reading()
+    streams = await async_start_tls(reader, writer)
+    if not streams:
+        return
+    reader, writer = streams
+    connections_total.inc()
+    set_keepalive(writer.get_extra_info("socket"))
+    async_local.last_read[writer] = time.monotonic()
+    async_start_writer(writer)
+    try:
+        await async_negotiate_protocol(reader, writer)
+    except (OSError, UnicodeDecodeError) as e:
+        logger.error(f"Handshake error from {writer.get_extra_info('peername')}: {e}")
+
+    started = time.perf_counter()
+    session = await async_handle_authentication(reader, writer)
+    auth_seconds.labels("success" if session else "failed").observe(time.perf_counter() - started)
+    if not session:
+        async_local.drop_wire_state(writer)
+        async_close_outbound(writer)
+        return
+    username, room = session
+
+    try:
+        await async_run_steps(enter_room_steps(async_local, writer, username, room))
+        while True:
+            data = await async_read_message(reader, writer)
+            if not data: break
+            await async_run_steps(command_steps(async_local, writer, username, data))
+
+    except (ConnectionResetError, ConnectionAbortedError):
+        session_log.info("Client %s disconnected unexpectedly.", username)
+    except OSError:
+        session_log.info("Connection for %s was closed.", username) # includes ssl.SSLError
+    except ProtocolError as e:
+        logger.info(f"Client {username} sent a bad frame: {e}")
+    except UnicodeDecodeError as e:
+        logger.info(f"Client {username} sent invalid UTF-8: {e}")
+    finally:
+        await async_run_steps(cleanup_steps(async_local, writer, username))
+
+def raise_fd_limit():
+    """Lifts the soft open-file limit to the hard limit so one process can hold 10k+ sockets."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError) as e:
+            logger.warning(f"Could not raise open file limit: {e}")
+    logger.info(f"Open file limit: {soft}")
+
+async def async_start_server():
+    global async_ssl_context, async_handshake_slots
+    init_db() # Seed users (sync client, runs once before serving)
+    start_auth_pool()
+    threading.Thread(target=log_outbound_stats, daemon=True).start()
+    threading.Thread(target=log_dropped_records, daemon=True).start()
+    start_metrics()
+    raise_fd_limit()
+
+    if state.clustered:
+        state.open_async()   # redis.asyncio clients belong to this event loop
+        asyncio.create_task(async_handle_redis_messages())
+        threading.Thread(target=negotiate_pubsub_encoding, daemon=True).start()
+        start_server_lease()
+    else:
+        asyncio.create_task(async_handle_local_messages())
+    asyncio.create_task(async_sweep_connections())
+
+    # TLS starts on each accepted connection (async_start_tls), so handshakes
+    # can be capped and their outcomes counted as in the threaded engine
+    async_ssl_context = ssl_context or create_ssl_context()
+    async_handshake_slots = asyncio.Semaphore(TLS_HANDSHAKE_CONCURRENCY)
+    server = await asyncio.start_server(
+        async_handle_client, HOST, PORT,
+        backlog=ASYNC_BACKLOG, reuse_address=True, reuse_port=SERVER_WORKERS > 1,
+    )
+    logger.info(f"Server listening on {HOST}:{PORT} (SSL Enabled, asyncio)")
+
+    async with server:
+        await server.serve_forever()
+
+# --- PRE-FORK WORKERS (SERVER_WORKERS > 1) ---
+# The supervisor forks SERVER_WORKERS copies of the server. Each worker has
+# its own listening socket on PORT (SO_REUSEPORT), Redis listener, local
+# client tables and auth pool; Redis is the only state they share.
+ssl_context = None   # created by the supervisor so all workers share TLS ticket keys
+worker_index = 0
+
+def run_server():
+    if SERVER_MODE == "asyncio":
+        asyncio.run(async_start_server())
+    else:
+        start_server()
+
+def run_worker(index):
+    """Entry point of a forked worker. Never returns."""
+    global worker_index, INSTANCE_ID
+    os.setpgid(0, 0)   # own process group, so its auth pool can be killed with it
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    worker_index = index
+    INSTANCE_ID = uuid.uuid4().hex   # each worker is a separate server to the cluster
+    fork_auth_workers()   # before the worker's log writer thread starts
+    setup_logging(f'%(asctime)s - %(levelname)s - [worker {index}] %(message)s', queue_size=LOG_QUEUE_SIZE)
+    try:
+        run_server()
+    except Exception:
+        logger.exception(f"Worker {index} crashed")
+    finally:
+        stop_logging()
+        os._exit(1)
+
+def kill_worker_group(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def supervise_workers():
+    """Forks SERVER_WORKERS workers on PORT and restarts any that exit."""
+    global ssl_context
+    init_db()   # once, before the workers race to do it
+    ssl_context = create_ssl_context()
+    workers = {}    # {pid: (index, started)}
+    failures = [0] * SERVER_WORKERS
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            run_worker(index)
+        try:
+            os.setpgid(pid, pid)   # also done by the child; whichever runs first wins
+        except OSError:
+            pass
+        workers[pid] = (index, time.monotonic())
+        logger.info(f"Started worker {index} (pid {pid})")
+
+    def shutdown(signum, frame):
+        logger.info(f"Supervisor received signal {signum}, stopping {len(workers)} workers")
+        for pid in workers:
+            kill_worker_group(pid, signal.SIGTERM)
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    for index in range(SERVER_WORKERS):
+        spawn(index)
+    logger.info(f"Supervisor {os.getpid()} running {SERVER_WORKERS} {SERVER_MODE} workers on port {PORT}")
+
+    while True:
+        pid, status = os.wait()
+        if pid not in workers:
+            continue
+        index, started = workers.pop(pid)
+        kill_worker_group(pid, signal.SIGKILL)   # its auth pool processes
+        logger.warning(f"Worker {index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}")
+        if time.monotonic() - started < WORKER_MIN_UPTIME:
+            delay = min(WORKER_RESTART_DELAY * 2 ** failures[index], 30)
+            failures[index] += 1
+            time.sleep(delay)
+        else:
+            failures[index] = 0
+        spawn(index)
+
 if __name__ == "__main__":
-    start_server()
+    if SERVER_WORKERS > 1:
+        supervise_workers()
+    else:
+        run_server()
@@ -0,0 +1,881 @@
+"""
+State backends for server.py: users, sessions, rooms, follows, resume
+records and room history, plus the bus that carries messages to listeners.
+
+    STATE_BACKEND=redis    RedisBackend, shared by every server (default)
+    STATE_BACKEND=memory   MemoryBackend, this process only: one server and
+                           no Redis, for small deployments, benchmarks and
+                           tests. Nothing is shared or survives a restart.
+
+Every operation has an async_ twin for the asyncio engine. Channels are
+"room:<name>", "pub:<user>" and "control_channel", as in the Redis schema.
+Only RedisBackend is `clustered`: the listener's history recovery, codec
+negotiation and server leases exist for other servers, so they are methods
+of RedisBackend alone.
+"""
+import asyncio
+import heapq
+import json
+import queue
+import secrets
+import threading
+import time
+from collections import deque
+
+import redis
+import redis.asyncio as aioredis
+
+from ratelimit import take_token
+
+class StateBackend:
+    """Operations server.py needs from a backend. The async_ twins default
+    to the sync method, which suits backends that never wait on I/O."""
+    clustered = False
+
+    def has_users(self):
+        raise NotImplementedError
+
+    def add_users(self, users):
+        """Stores {username: bcrypt hash}."""
+        raise NotImplementedError
+
+    def rebuild_room_index(self):
+        """Derives the room index from older data. Returns rooms added."""
+        return 0
+
+    def password_hash(self, username):
+        """The user's bcrypt hash (str), or None."""
+        raise NotImplementedError
+
+    def add_user(self, username, password_hash):
+        """False if the username is taken."""
+        raise NotImplementedError
+
+    def session_holder(self, username):
+        """(True if username has a session, id of the server owning it or None)."""
+        raise NotImplementedError
+
+    def register_session(self, username, room, server_id):
+        raise NotImplementedError
+
+    def enter_room(self, username, room, announcement):
+        """Adds username to room and announces it there."""
+        raise NotImplementedError
+
+    def switch_room(self, username, room):
+        """Moves username, announcing the leave and the join. Returns the old room."""
+        raise NotImplementedError
+
+    def end_session(self, username, resume_id, server_id):
+        """Removes server_id's session of username, keeping its room for
+        RESUME if resume_id is still current. Returns the room, or None if
+        there was no such session."""
+        raise NotImplementedError
+
+    def store_resume_token(self, username, token_id, room, ttl):
+        raise NotImplementedError
+
+    def resume_record(self, username):
+        """({"id": current token id, "room": saved room} or {}, live session room or None)."""
+        raise NotImplementedError
+
+    def rooms_page(self, start, count):
+        """([(room, members)] busiest first, from position start; total rooms)."""
+        raise NotImplementedError
+
+    def follows(self, username):
+        """Set of publishers username is subscribed to."""
+        raise NotImplementedError
+
+    def follow(self, username, publisher, notice):
+        """Subscribes username to publisher and publishes notice on control_channel."""
+        raise NotImplementedError
+
+    def unfollow(self, username, publisher, notice):
+        raise NotImplementedError
+
+    def publish(self, channel, payload):
+        raise NotImplementedError
+
+    def publish_room(self, room, channel, payload, followers_channel=None, followers_payload="",
+                     room_rate=0, room_burst=1):
+        """Appends payload to room's history and publishes it on channel.
+        followers_payload goes to followers_channel; empty means payload.
+        With a room_rate, the room has a token bucket shared by all servers
+        (room_rate messages a second, room_burst at once). False if it was
+        empty and nothing was published."""
+        raise NotImplementedError
+
+    def room_history(self, room, count):
+        """The room's last count payloads, oldest first."""
+        raise NotImplementedError
+
+    def ack(self, key):
+        """Acknowledges the FORCE_LOGOUT whose ack key is key."""
+        raise NotImplementedError
+
+    def wait_ack(self, key, timeout):
+        """True once key is acked, False after timeout seconds."""
+        raise NotImplementedError
+
+    def shared_secret(self, name):
+        """A random secret, the same for every server sharing this backend."""
+        raise NotImplementedError
+
+    async def async_password_hash(self, username):
+        return self.password_hash(username)
+
+    async def async_add_user(self, username, password_hash):
+        return self.add_user(username, password_hash)
+
+    async def async_session_holder(self, username):
+        return self.session_holder(username)
+
+    async def async_register_session(self, username, room, server_id):
+        return self.register_session(username, room, server_id)
+
+    async def async_enter_room(self, username, room, announcement):
+        return self.enter_room(username, room, announcement)
+
+    async def async_switch_room(self, username, room):
+        return self.switch_room(username, room)
+
+    async def async_end_session(self, username, resume_id, server_id):
+        return self.end_session(username, resume_id, server_id)
+
+    async def async_store_resume_token(self, username, token_id, room, ttl):
+        return self.store_resume_token(username, token_id, room, ttl)
+
+    async def async_resume_record(self, username):
+        return self.resume_record(username)
+
+    async def async_rooms_page(self, start, count):
+        return self.rooms_page(start, count)
+
+    async def async_follows(self, username):
+        return self.follows(username)
+
+    async def async_follow(self, username, publisher, notice):
+        return self.follow(username, publisher, notice)
+
+    async def async_unfollow(self, username, publisher, notice):
+        return self.unfollow(username, publisher, notice)
+
+    async def async_publish(self, channel, payload):
+        return self.publish(channel, payload)
+
+    async def async_publish_room(self, room, channel, payload, followers_channel=None, followers_payload="",
+                                 room_rate=0, room_burst=1):
+        return self.publish_room(room, channel, payload, followers_channel, followers_payload, room_rate, room_burst)
+
+    async def async_room_history(self, room, count):
+        return self.room_history(room, count)
+
+    async def async_ack(self, key):
+        return self.ack(key)
+
+    async def async_wait_ack(self, key, timeout):
+        return self.wait_ack(key, timeout)
+
+# --- REDIS ---
+# Session state transitions run as server-side scripts: one round-trip each,
+# and no other client can observe (or a crash can leave) a half-done move.
+# The room set key and the room's pub/sub channel are both "room:<name>".
+# KEYS[2] is the rooms_index sorted set (room -> member count), which every
+# script keeps in step with the room sets and prunes when a room empties.
+ROOM_INDEX_LUA = """
+local function refresh_room(room)
+    local count = redis.call('SCARD', 'room:' .. room)
+    if count > 0 then
+        redis.call('ZADD', KEYS[2], count, room)
+    else
+        redis.call('ZREM', KEYS[2], room)
+    end
+end
+"""
+
+SWITCH_ROOM_LUA = ROOM_INDEX_LUA + """
+local username, new_room = ARGV[1], ARGV[2]
+local old_room = redis.call('HGET', KEYS[1], username)
+if old_room then
+    redis.call('SREM', 'room:' .. old_room, username)
+    refresh_room(old_room)
+    redis.call('PUBLISH', 'room:' .. old_room, cjson.encode({
+        type = 'BROADCAST', sender = username, room = old_room,
+        content = username .. ' left ' .. old_room}))
+end
+redis.call('SADD', 'room:' .. new_room, username)
+refresh_room(new_room)
+redis.call('HSET', KEYS[1], username, new_room)
+redis.call('PUBLISH', 'room:' .. new_room, cjson.encode({
+    type = 'BROADCAST', sender = username, room = new_room,
+    content = username .. ' joined ' .. new_room}))
+return old_room
+"""
+
+ENTER_ROOM_LUA = ROOM_INDEX_LUA + """
+local username, room, content = ARGV[1], ARGV[2], ARGV[3]
+redis.call('SADD', 'room:' .. room, username)
+refresh_room(room)
+redis.call('PUBLISH', 'room:' .. room, cjson.encode({
+    type = 'BROADCAST', sender = username, room = room, content = content}))
+"""
+
+CLEANUP_SESSION_LUA = ROOM_INDEX_LUA + """
+local username, server = ARGV[1], ARGV[3]
+redis.call('SREM', 'server_sessions:' .. server, username)
+-- A login on another server took the session over (or it was reaped)
+local owner = redis.call('HGET', 'session_owner', username)
+if owner and owner ~= server then
+    return false
+end
+local room = redis.call('HGET', KEYS[1], username)
+if not room then
+    return false
+end
+redis.call('SREM', 'room:' .. room, username)
+refresh_room(room)
+redis.call('HDEL', KEYS[1], username)
+redis.call('HDEL', 'session_owner', username)
+-- Remember the room for RESUME, unless a newer login already replaced the token
+local resume_key = 'resume:' .. username
+if ARGV[2] and ARGV[2] ~= '' and redis.call('HGET', resume_key, 'id') == ARGV[2] then
+    redis.call('HSET', resume_key, 'room', room)
+end
+redis.call('PUBLISH', 'room:' .. room, cjson.encode({
+    type = 'BROADCAST', sender = username, room = room,
+    content = username .. ' left the chat'}))
+return room
+"""
+
+# Appends a room message to the room's capped history stream and publishes it
+# tagged with the entry id, in the same order, so receivers can tell what
+# they missed. Binary envelopes get the id appended (the sender set
+# FLAG_STREAM_ID); JSON payloads get an "id" field. A maxlen of 0 skips the
+# stream. Chat lines also pass the sender's publisher channel and its
+# payload (ARGV[6], ARGV[7]); an empty payload there means the merged CHAT
+# message, which followers get as it was sent, without the id.
+# KEYS[2], if given, is the room's token bucket (a hash of tokens and the
+# Redis TIME of the last refill), refilled at ARGV[8] tokens a second up to
+# ARGV[9]. Without a token nothing is published and the script returns -1.
+# The bucket expires once it would be full again.
+PUBLISH_ROOM_LUA = """
+local channel, payload, maxlen, ttl, encoding = ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5]
+if KEYS[2] then
+    local rate, burst = tonumber(ARGV[8]), tonumber(ARGV[9])
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local bucket = redis.call('HMGET', KEYS[2], 'tokens', 'ts')
+    local tokens = burst
+    if bucket[1] then
+        tokens = math.min(burst, tonumber(bucket[1]) + (now - tonumber(bucket[2])) * rate)
+    end
+    if tokens < 1 then
+        return -1
+    end
+    redis.call('HSET', KEYS[2], 'tokens', tostring(tokens - 1), 'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[2], math.ceil(burst / rate) + 1)
+end
+local published, id = payload, false
+if maxlen ~= '0' then
+    id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', maxlen, '*', 'msg', payload)
+    redis.call('EXPIRE', KEYS[1], ttl)
+    if encoding == 'binary' then
+        published = payload .. id
+    else
+        local message = cjson.decode(payload)
+        message['id'] = id
+        published = cjson.encode(message)
+    end
+end
+redis.call('PUBLISH', channel, published)
+if ARGV[6] and ARGV[6] ~= '' then
+    redis.call('PUBLISH', ARGV[6], ARGV[7] ~= '' and ARGV[7] or payload)
+end
+return id
+"""
+
+# Removes sessions owned by server ARGV[1] once its lease has expired:
+# ARGV[2] of them per call, or only user ARGV[3]. Sessions a newer login
+# took over are left alone. KEYS are lease_keys(server).
+# Returns {sessions the server still owns (-1 if it is alive), reaped}.
+REAP_SESSIONS_LUA = ROOM_INDEX_LUA + """
+local server, batch, only = ARGV[1], ARGV[2], ARGV[3]
+if redis.call('EXISTS', 'server_lease:' .. server) == 1 then
+    return {-1, 0}
+end
+local users
+if only then
+    users = {only}
+    redis.call('SREM', KEYS[4], only)
+else
+    users = redis.call('SPOP', KEYS[4], batch)
+end
+local reaped = 0
+for _, username in ipairs(users) do
+    if redis.call('HGET', KEYS[3], username) == server then
+        redis.call('HDEL', KEYS[3], username)
+        local room = redis.call('HGET', KEYS[1], username)
+        if room then
+            redis.call('HDEL', KEYS[1], username)
+            redis.call('SREM', 'room:' .. room, username)
+            refresh_room(room)
+            if redis.call('EXISTS', 'resume:' .. username) == 1 then
+                redis.call('HSET', 'resume:' .. username, 'room', room)
+            end
+            redis.call('PUBLISH', 'room:' .. room, cjson.encode({
+                type = 'BROADCAST', sender = username, room = room,
+                content = username .. ' left the chat'}))
+        end
+        reaped = reaped + 1
+    end
+end
+local left = redis.call('SCARD', KEYS[4])
+if left == 0 then
+    redis.call('SREM', KEYS[5], server)
+end
+return {left, reaped}
+"""
+
+# Stores server ARGV[1]'s advert ARGV[3] (JSON) in the server_adverts hash
+# for ARGV[2] seconds, as "<expiry> <advert>" with the expiry in Redis TIME,
+# and returns every unexpired advert, removing the expired ones.
+ADVERTISE_LUA = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+redis.call('HSET', KEYS[1], ARGV[1], tostring(now + tonumber(ARGV[2])) .. ' ' .. ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+local entries, live = redis.call('HGETALL', KEYS[1]), {}
+for i = 1, #entries, 2 do
+    local expiry, advert = string.match(entries[i + 1], '^(%S+) (.*)$')
+    if tonumber(expiry) > now then
+        table.insert(live, advert)
+    else
+        redis.call('HDEL', KEYS[1], entries[i])
+    end
+end
+return live
+"""
+
+# Puts back a session of server ARGV[1] after its lease lapsed, unless the
+# user has logged in again since. KEYS are lease_keys(server).
+RESTORE_SESSION_LUA = ROOM_INDEX_LUA + """
+local server, username, room = ARGV[1], ARGV[2], ARGV[3]
+if redis.call('HSETNX', KEYS[1], username, room) == 0 then
+    return 0
+end
+redis.call('SADD', 'room:' .. room, username)
+refresh_room(room)
+redis.call('HSET', KEYS[3], username, server)
+redis.call('SADD', KEYS[4], username)
+return 1
+"""
+
+SESSION_KEYS = ["user_sessions", "rooms_index"]
+
+# Every server holds server_lease:<id> and records the sessions it owns in
+# session_owner (user -> id) and server_sessions:<id>; see server.py.
+def lease_key(server_id):
+    return f"server_lease:{server_id}"
+
+def owned_sessions_key(server_id):
+    return f"server_sessions:{server_id}"
+
+def lease_keys(server_id):
+    return ["user_sessions", "rooms_index", "session_owner", owned_sessions_key(server_id), "servers"]
+
+def resume_key(username):
+    return f"resume:{username}"
+
+# Room broadcasts are also appended to history:<room>, a stream capped at
+# about history_maxlen entries that expires history_ttl seconds after its
+# last message.
+def history_key(room):
+    return f"history:{room}"
+
+def room_rate_key(room):
+    return f"room_rate:{room}"
+
+class RedisBackend(StateBackend):
+    """State in Redis, shared by every server. Raises redis.ConnectionError
+    if Redis is unreachable."""
+    clustered = True
+
+    def __init__(self, host, port, history_maxlen, history_ttl):
+        self.host, self.port = host, port
+        self.history_maxlen, self.history_ttl = history_maxlen, history_ttl
+        self.r = redis.Redis(host=host, port=port, decode_responses=True)
+        self.r.ping()
+        self.history = redis.Redis(host=host, port=port)   # bytes: entries may be binary envelopes
+        self.switch_room_script = self.r.register_script(SWITCH_ROOM_LUA)
+        self.enter_room_script = self.r.register_script(ENTER_ROOM_LUA)
+        self.cleanup_session_script = self.r.register_script(CLEANUP_SESSION_LUA)
+        self.publish_room_script = self.r.register_script(PUBLISH_ROOM_LUA)
+        self.reap_sessions_script = self.r.register_script(REAP_SESSIONS_LUA)
+        self.restore_session_script = self.r.register_script(RESTORE_SESSION_LUA)
+        self.advertise_script = self.r.register_script(ADVERTISE_LUA)
+        self.ar = None   # redis.asyncio clients, created inside the event loop by open_async
+
+    def open_async(self):
+        self.ar = aioredis.Redis(host=self.host, port=self.port, decode_responses=True)
+        self.async_history = aioredis.Redis(host=self.host, port=self.port)
+        self.async_switch_room_script = self.ar.register_script(SWITCH_ROOM_LUA)
+        self.async_enter_room_script = self.ar.register_script(ENTER_ROOM_LUA)
+        self.async_cleanup_session_script = self.ar.register_script(CLEANUP_SESSION_LUA)
+        self.async_publish_room_script = self.ar.register_script(PUBLISH_ROOM_LUA)
+        self.async_reap_sessions_script = self.ar.register_script(REAP_SESSIONS_LUA)
+
+    def publish_room_call(self, room, channel, payload, followers_channel, followers_payload, room_rate, room_burst):
+        """keys and args of PUBLISH_ROOM_LUA."""
+        keys = [history_key(room)]
+        args = [channel, payload, self.history_maxlen, self.history_ttl,
+                "binary" if isinstance(payload, bytes) else "json"]
+        if followers_channel or room_rate:
+            args += [followers_channel or "", followers_payload]
+        if room_rate:
+            keys.append(room_rate_key(room))
+            args += [room_rate, max(room_burst, 1)]
+        return {"keys": keys, "args": args}
+
+    # --- users ---
+    def has_users(self):
+        return self.r.exists("users")
+
+    def add_users(self, users):
+        self.r.hset("users", mapping=users)
+
+    def rebuild_room_index(self):
+        # One-off backfill of the room registry from room sets created before
+        # it existed. SCAN is incremental, unlike the KEYS call /rooms used to make.
+        if self.r.exists("rooms_index"):
+            return 0
+        counts = {}
+        for key in self.r.scan_iter("room:*", count=1000, _type="SET"):
+            counts[key.split(":", 1)[1]] = self.r.scard(key)
+        if counts:
+            self.r.zadd("rooms_index", counts)
+        return len(counts)
+
+    def password_hash(self, username):
+        return self.r.hget("users", username)
+
+    def add_user(self, username, password_hash):
+        return bool(self.r.hsetnx("users", username, password_hash))
+
+    # --- sessions ---
+    def session_holder(self, username):
+        return tuple(self.r.pipeline().hexists("user_sessions", username).hget("session_owner", username).execute())
+
+    def register_session(self, username, room, server_id):
+        self.r.pipeline().hset("user_sessions", username, room).hset("session_owner", username, server_id) \
+            .sadd(owned_sessions_key(server_id), username).execute()
+
+    def enter_room(self, username, room, announcement):
+        self.enter_room_script(keys=SESSION_KEYS, args=[username, room, announcement])
+
+    def switch_room(self, username, room):
+        return self.switch_room_script(keys=SESSION_KEYS, args=[username, room])
+
+    def end_session(self, username, resume_id, server_id):
+        return self.cleanup_session_script(keys=SESSION_KEYS, args=[username, resume_id, server_id]) or None
+
+    def store_resume_token(self, username, token_id, room, ttl):
+        self.r.pipeline().hset(resume_key(username), mapping={"id": token_id, "room": room}) \
+            .expire(resume_key(username), ttl).execute()
+
+    def resume_record(self, username):
+        return tuple(self.r.pipeline(transaction=False).hgetall(resume_key(username))
+                     .hget("user_sessions", username).execute())
+
+    def rooms_page(self, start, count):
+        entries, total = self.r.pipeline(transaction=False).zrevrange(
+            "rooms_index", start, start + count - 1, withscores=True).zcard("rooms_index").execute()
+        return [(room, int(members)) for room, members in entries], total
+
+    # --- follows ---
+    def follows(self, username):
+        return self.r.smembers(f"subscribed_to:{username}")
+
+    def follow(self, username, publisher, notice):
+        self.r.pipeline().sadd(f"subscriptions:{publisher}", username) \
+            .sadd(f"subscribed_to:{username}", publisher).publish("control_channel", notice).execute()
+
+    def unfollow(self, username, publisher, notice):
+        self.r.pipeline().srem(f"subscriptions:{publisher}", username) \
+            .srem(f"subscribed_to:{username}", publisher).publish("control_channel", notice).execute()
+
+    # --- messages ---
+    def publish(self, channel, payload):
+        self.r.publish(channel, payload)
+
+    def publish_room(self, room, channel, payload, followers_channel=None, followers_payload="",
+                     room_rate=0, room_burst=1):
+        return self.publish_room_script(**self.publish_room_call(
+            room, channel, payload, followers_channel, followers_payload, room_rate, room_burst)) != -1
+
+    def room_history(self, room, count):
+        entries = self.history.xrevrange(history_key(room), count=count)
+        return [fields[b"msg"] for _, fields in reversed(entries) if b"msg" in fields]
+
+    def ack(self, key):
+        self.r.pipeline().rpush(key, 1).expire(key, 10).execute()
+
+    def wait_ack(self, key, timeout):
+        return bool(self.r.blpop(key, timeout=timeout))
+
+    def shared_secret(self, name):
+        self.r.set(name, secrets.token_hex(32), nx=True)
+        return self.r.get(name)
+
+    # --- cluster: listener, history recovery, codec adverts, leases ---
+    def open_pubsub(self):
+        # Binary payloads are not UTF-8, so this connection does not decode responses
+        return redis.Redis(host=self.host, port=self.port).pubsub()
+
+    def history_heads(self, rooms):
+        """Id of the newest history entry of each room, or None."""
+        pipe = self.history.pipeline(transaction=False)
+        for room in rooms:
+            pipe.xrevrange(history_key(room), count=1)
+        return [entries[0][0].decode() if entries else None for entries in pipe.execute()]
+
+    def history_after(self, rooms, after_ids):
+        """[(id, payload)] of each room's entries after the given id."""
+        pipe = self.history.pipeline(transaction=False)
+        for room, after in zip(rooms, after_ids):
+            pipe.xrange(history_key(room), min=after)
+        return [[(stream_id.decode(), fields[b"msg"]) for stream_id, fields in entries]
+                for entries in pipe.execute()]
+
+    def advertise(self, server_id, advert, ttl):
+        """Publishes server_id's advert ({name: version}) for ttl seconds and
+        returns the unexpired adverts of every server, this one included."""
+        adverts = self.advertise_script(keys=["server_adverts"], args=[server_id, ttl, json.dumps(advert)])
+        return [json.loads(advert) for advert in adverts]
+
+    def subscriber_count(self, channel):
+        return dict(self.r.pubsub_numsub(channel)).get(channel, 0)
+
+    def register_server(self, server_id, ttl):
+        self.r.pipeline().set(lease_key(server_id), 1, ex=ttl).sadd("servers", server_id).execute()
+
+    def renew_lease(self, server_id, ttl):
+        """False if the lease had already expired."""
+        return bool(self.r.set(lease_key(server_id), 1, ex=ttl, xx=True))
+
+    def expired_servers(self):
+        servers = list(self.r.smembers("servers"))
+        pipe = self.r.pipeline(transaction=False)
+        for server_id in servers:
+            pipe.exists(lease_key(server_id))
+        return [server_id for server_id, alive in zip(servers, pipe.execute()) if not alive]
+
+    def reap_sessions(self, server_id, batch, username=None):
+        """Runs REAP_SESSIONS_LUA once. Returns (left, reaped)."""
+        args = [server_id, batch] + ([username] if username else [])
+        return tuple(self.reap_sessions_script(keys=lease_keys(server_id), args=args))
+
+    def restore_session(self, server_id, username, room):
+        return self.restore_session_script(keys=lease_keys(server_id), args=[server_id, username, room])
+
+    # --- asyncio twins ---
+    async def async_password_hash(self, username):
+        return await self.ar.hget("users", username)
+
+    async def async_add_user(self, username, password_hash):
+        return bool(await self.ar.hsetnx("users", username, password_hash))
+
+    async def async_session_holder(self, username):
+        return tuple(await self.ar.pipeline().hexists("user_sessions", username)
+                     .hget("session_owner", username).execute())
+
+    async def async_register_session(self, username, room, server_id):
+        await self.ar.pipeline().hset("user_sessions", username, room).hset("session_owner", username, server_id) \
+            .sadd(owned_sessions_key(server_id), username).execute()
+
+    async def async_enter_room(self, username, room, announcement):
+        await self.async_enter_room_script(keys=SESSION_KEYS, args=[username, room, announcement])
+
+    async def async_switch_room(self, username, room):
+        return await self.async_switch_room_script(keys=SESSION_KEYS, args=[username, room])
+
+    async def async_end_session(self, username, resume_id, server_id):
+        return await self.async_cleanup_session_script(keys=SESSION_KEYS, args=[username, resume_id, server_id]) or None
+
+    async def async_store_resume_token(self, username, token_id, room, ttl):
+        await self.ar.pipeline().hset(resume_key(username), mapping={"id": token_id, "room": room}) \
+            .expire(resume_key(username), ttl).execute()
+
+    async def async_resume_record(self, username):
+        return tuple(await self.ar.pipeline(transaction=False).hgetall(resume_key(username))
+                     .hget("user_sessions", username).execute())
+
+    async def async_rooms_page(self, start, count):
+        entries, total = await self.ar.pipeline(transaction=False).zrevrange(
+            "rooms_index", start, start + count - 1, withscores=True).zcard("rooms_index").execute()
+        return [(room, int(members)) for room, members in entries], total
+
+    async def async_follows(self, username):
+        return await self.ar.smembers(f"subscribed_to:{username}")
+
+    async def async_follow(self, username, publisher, notice):
+        await self.ar.pipeline().sadd(f"subscriptions:{publisher}", username) \
+            .sadd(f"subscribed_to:{username}", publisher).publish("control_channel", notice).execute()
+
+    async def async_unfollow(self, username, publisher, notice):
+        await self.ar.pipeline().srem(f"subscriptions:{publisher}", username) \
+            .srem(f"subscribed_to:{username}", publisher).publish("control_channel", notice).execute()
+
+    async def async_publish(self, channel, payload):
+        await self.ar.publish(channel, payload)
+
+    async def async_publish_room(self, room, channel, payload, followers_channel=None, followers_payload="",
+                                 room_rate=0, room_burst=1):
+        return await self.async_publish_room_script(**self.publish_room_call(
+            room, channel, payload, followers_channel, followers_payload, room_rate, room_burst)) != -1
+
+    async def async_room_history(self, room, count):
+        entries = await self.async_history.xrevrange(history_key(room), count=count)
+        return [fields[b"msg"] for _, fields in reversed(entries) if b"msg" in fields]
+
+    async def async_ack(self, key):
+        await self.ar.pipeline().rpush(key, 1).expire(key, 10).execute()
+
+    async def async_wait_ack(self, key, timeout):
+        return bool(await self.ar.blpop(key, timeout=timeout))
+
+    def async_open_pubsub(self):
+        return aioredis.Redis(host=self.host, port=self.port).pubsub()   # bytes, see open_pubsub
+
+    async def async_history_heads(self, rooms):
+        pipe = self.async_history.pipeline(transaction=False)
+        for room in rooms:
+            pipe.xrevrange(history_key(room), count=1)
+        return [entries[0][0].decode() if entries else None for entries in await pipe.execute()]
+
+    async def async_history_after(self, rooms, after_ids):
+        pipe = self.async_history.pipeline(transaction=False)
+        for room, after in zip(rooms, after_ids):
+            pipe.xrange(history_key(room), min=after)
+        return [[(stream_id.decode(), fields[b"msg"]) for stream_id, fields in entries]
+                for entries in await pipe.execute()]
+
+    async def async_reap_sessions(self, server_id, batch, username=None):
+        args = [server_id, batch] + ([username] if username else [])
+        return tuple(await self.async_reap_sessions_script(keys=lease_keys(server_id), args=args))
+
+# --- IN-MEMORY ---
+def room_announcement(username, room, content):
+    """Join/leave notice, as the Redis scripts publish it."""
+    return json.dumps({"type": "BROADCAST", "sender": username, "room": room, "content": content})
+
+ACK_TTL = 10   # seconds an ack nobody waits for is kept, as force_ack keys expire in Redis
+
+def unclaimed_ack(acks, key, make_event):
+    """acks[key], added with an expiry if no waiter has added it. An ack can
+    come before wait_ack starts, or after it gave up; the expiry drops the
+    late ones."""
+    now = time.monotonic()
+    for expired in [k for k, (_, expires) in acks.items() if expires and expires < now]:
+        del acks[expired]
+    return acks.setdefault(key, (make_event(), now + ACK_TTL))
+
+class MemoryBackend(StateBackend):
+    """State in this process's dicts, the model of server_Tasks_1-5.py.
+
+    Published messages go on `bus`, a queue of (channel, payload) that the
+    server's listener drains like a Redis subscription, and on_publish (if
+    set) is called after each publish. Sessions belong to this process, so
+    there are no owners to reap and no other servers to agree with.
+    """
+
+    def __init__(self, history_maxlen):
+        self.history_maxlen = history_maxlen
+        self.user_db = {}         # {username: bcrypt hash}
+        self.sessions = {}        # {username: room}
+        self.rooms = {}           # {room: {usernames}}
+        self.subscriptions = {}   # {publisher: {subscribers}}
+        self.subscribed_to = {}   # {subscriber: {publishers}}
+        self.resume = {}          # {username: ({"id": ..., "room": ...}, expires)}
+        self.history = {}         # {room: deque of payloads}
+        self.room_rates = {}      # {room: [tokens, time.monotonic() of the last refill]}
+        self.acks = {}            # {ack key: (threading.Event, expiry if no waiter yet)}
+        self.async_acks = {}      # {ack key: (asyncio.Event, expiry if no waiter yet)}
+        self.lock = threading.Lock()
+        self.bus = queue.SimpleQueue()
+        self.on_publish = None
+
+    def put(self, channel, payload):
+        """Queues a message for the listener. Called under the lock, so the
+        bus and the room histories see messages in the same order."""
+        self.bus.put((channel, payload))
+
+    def notify(self):
+        if self.on_publish:
+            self.on_publish()
+
+    def join(self, username, room):
+        self.rooms.setdefault(room, set()).add(username)
+
+    def leave(self, username, room):
+        members = self.rooms.get(room)
+        if members is not None:
+            members.discard(username)
+            if not members:
+                del self.rooms[room]
+                self.room_rates.pop(room, None)
+
+    def has_users(self):
+        return bool(self.user_db)
+
+    def add_users(self, users):
+        with self.lock:
+            self.user_db.update(users)
+
+    def password_hash(self, username):
+        return self.user_db.get(username)
+
+    def add_user(self, username, password_hash):
+        with self.lock:
+            if username in self.user_db:
+                return False
+            self.user_db[username] = password_hash
+            return True
+
+    def session_holder(self, username):
+        return username in self.sessions, None
+
+    def register_session(self, username, room, server_id):
+        with self.lock:
+            self.sessions[username] = room
+
+    def enter_room(self, username, room, announcement):
+        with self.lock:
+            self.join(username, room)
+            self.put(f"room:{room}", room_announcement(username, room, announcement))
+        self.notify()
+
+    def switch_room(self, username, room):
+        with self.lock:
+            old_room = self.sessions.get(username)
+            if old_room:
+                self.leave(username, old_room)
+                self.put(f"room:{old_room}", room_announcement(username, old_room, f"{username} left {old_room}"))
+            self.join(username, room)
+            self.sessions[username] = room
+            self.put(f"room:{room}", room_announcement(username, room, f"{username} joined {room}"))
+        self.notify()
+        return old_room
+
+    def end_session(self, username, resume_id, server_id):
+        with self.lock:
+            room = self.sessions.pop(username, None)
+            if room is None:
+                return None
+            self.leave(username, room)
+            record = self.resume.get(username)
+            if resume_id and record and record[0]["id"] == resume_id:
+                record[0]["room"] = room
+            self.put(f"room:{room}", room_announcement(username, room, f"{username} left the chat"))
+        self.notify()
+        return room
+
+    def store_resume_token(self, username, token_id, room, ttl):
+        with self.lock:
+            self.resume[username] = ({"id": token_id, "room": room}, time.time() + ttl)
+
+    def resume_record(self, username):
+        with self.lock:
+            record, expires = self.resume.get(username, ({}, 0))
+            if expires < time.time():
+                self.resume.pop(username, None)
+                record = {}
+            return dict(record), self.sessions.get(username)
+
+    def rooms_page(self, start, count):
+        with self.lock:
+            busiest = heapq.nlargest(start + count, ((len(members), room) for room, members in self.rooms.items()))
+            total = len(self.rooms)
+        return [(room, members) for members, room in busiest[start:]], total
+
+    def follows(self, username):
+        with self.lock:
+            return set(self.subscribed_to.get(username, ()))
+
+    def follow(self, username, publisher, notice):
+        with self.lock:
+            self.subscriptions.setdefault(publisher, set()).add(username)
+            self.subscribed_to.setdefault(username, set()).add(publisher)
+            self.put("control_channel", notice)
+        self.notify()
+
+    def unfollow(self, username, publisher, notice):
+        with self.lock:
+            for index, key, member in ((self.subscriptions, publisher, username),
+                                       (self.subscribed_to, username, publisher)):
+                members = index.get(key)
+                if members is not None:
+                    members.discard(member)
+                    if not members:
+                        del index[key]
+            self.put("control_channel", notice)
+        self.notify()
+
+    def publish(self, channel, payload):
+        with self.lock:
+            self.put(channel, payload)
+        self.notify()
+
+    def publish_room(self, room, channel, payload, followers_channel=None, followers_payload="",
+                     room_rate=0, room_burst=1):
+        with self.lock:
+            if room_rate:
+                now = time.monotonic()
+                bucket = self.room_rates.setdefault(room, [max(room_burst, 1), now])
+                if not take_token(bucket, now, room_rate, max(room_burst, 1)):
+                    return False
+            if self.history_maxlen:
+                history = self.history.get(room)
+                if history is None:
+                    history = self.history[room] = deque(maxlen=self.history_maxlen)
+                history.append(payload)
+            self.put(channel, payload)
+            if followers_channel:
+                self.put(followers_channel, followers_payload or payload)
+        self.notify()
+        return True
+
+    def room_history(self, room, count):
+        with self.lock:
+            history = self.history.get(room, ())
+            return list(history)[-count:] if count else []
+
+    def ack(self, key):
+        with self.lock:
+            event, _ = unclaimed_ack(self.acks, key, threading.Event)
+        event.set()
+
+    def wait_ack(self, key, timeout):
+        with self.lock:
+            event, _ = self.acks.setdefault(key, (threading.Event(), None))
+        acked = event.wait(timeout)
+        with self.lock:
+            self.acks.pop(key, None)
+        return acked
+
+    def shared_secret(self, name):
+        return secrets.token_hex(32)   # no other server to share it with
+
+    async def async_ack(self, key):
+        event, _ = unclaimed_ack(self.async_acks, key, asyncio.Event)
+        event.set()
+
+    async def async_wait_ack(self, key, timeout):
+        event, _ = self.async_acks.setdefault(key, (asyncio.Event(), None))
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.async_acks.pop(key, None)
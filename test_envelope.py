@@ -0,0 +1,46 @@
+"""
+Tests for envelope.py, the binary pub/sub payload.
+
+    python -m pytest test_envelope.py
+"""
+import json
+
+import pytest
+
+from envelope import EnvelopeError, decode_envelope, decode_payload, encode_envelope, is_envelope
+
+def test_round_trip():
+    data = encode_envelope("BROADCAST", "alice", "héllo", "lobby", ts=12.5)
+    assert is_envelope(data)
+    assert decode_payload(data) == {"type": "BROADCAST", "sender": "alice", "room": "lobby",
+                                    "content": "héllo".encode(), "ts": 12.5}
+
+def test_round_trip_without_room_and_with_bytes_content():
+    message = decode_envelope(encode_envelope("PUBSUB", "alice", b"[alice] hi"))
+    assert (message["type"], message["room"], message["content"]) == ("PUBSUB", None, b"[alice] hi")
+    assert "id" not in message
+
+def test_stream_id_appended_after_the_content():
+    # PUBLISH_ROOM_LUA appends the history stream id to envelopes that ask for it
+    data = encode_envelope("CHAT", "alice", "hi", "lobby", stream_id_follows=True) + b"1700000000000-3"
+    message = decode_payload(data)
+    assert message["content"] == b"hi"
+    assert message["id"] == "1700000000000-3"
+
+def test_stream_id_flag_without_an_id_yet():
+    message = decode_envelope(encode_envelope("CHAT", "alice", "hi", "lobby", stream_id_follows=True))
+    assert "id" not in message
+
+def test_json_payloads_still_decode():
+    payload = json.dumps({"type": "BROADCAST", "sender": "alice", "room": "lobby", "content": "hi"})
+    assert decode_payload(payload)["content"] == "hi"
+    assert decode_payload(payload.encode())["content"] == "hi"
+
+def test_truncated_and_unknown_envelopes_are_rejected():
+    data = encode_envelope("BROADCAST", "alice", "hello", "lobby")
+    with pytest.raises(EnvelopeError):
+        decode_envelope(data[:10])
+    with pytest.raises(EnvelopeError):
+        decode_envelope(data[:-1])
+    with pytest.raises(EnvelopeError):
+        decode_envelope(data[:1] + bytes([99]) + data[2:])
@@ -0,0 +1,48 @@
+"""
+Tests for loadgen.py against a real server.py (see conftest.py).
+
+    python -m pytest test_loadgen.py
+"""
+import threading
+import time
+import uuid
+
+import pytest
+
+from client import create_ssl_context
+from loadgen import MARKER, Recorder, SimUser
+
+PING_INTERVAL = 0.5
+IDLE_TIMEOUT = 1.5
+
+@pytest.fixture
+def server_port(start_server, cert_dir, monkeypatch):
+    monkeypatch.chdir(cert_dir)   # create_ssl_context() reads server.crt from here
+    return start_server(PING_INTERVAL=str(PING_INTERVAL), IDLE_TIMEOUT=str(IDLE_TIMEOUT))
+
+def connect(port, recorder):
+    user = SimUser(f"lgtest{uuid.uuid4().hex[:8]}", "loadgen", port)
+    ok, _, response = user.connect(create_ssl_context(), "127.0.0.1")
+    assert ok, response
+    receiver = threading.Thread(target=user.receive, args=(recorder,), daemon=True)
+    receiver.start()
+    return user, receiver
+
+def test_silent_listener_outlives_idle_timeout(server_port):
+    recorder = Recorder()
+    listener, receiver = connect(server_port, recorder)
+    sender, _ = connect(server_port, recorder)
+    try:
+        # Only PINGs reach the listener; its PONGs must keep it connected
+        time.sleep(IDLE_TIMEOUT * 2)
+        assert receiver.is_alive(), "listener was disconnected while idle"
+
+        recorder.recording = True
+        sender.send(f"{MARKER} {time.time_ns()} 0")
+        deadline = time.time() + 5
+        while recorder.received < 1 and time.time() < deadline:
+            time.sleep(0.05)
+        assert recorder.received == 1
+    finally:
+        listener.close()
+        sender.close()
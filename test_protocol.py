@@ -0,0 +1,71 @@
+"""
+Tests for protocol.py's framing and for how server.py picks a connection's
+wire mode. No Redis or certificate needed.
+
+    python -m pytest test_protocol.py
+"""
+import os
+
+import pytest
+
+from protocol import (FRAMED_MAGIC, FRAME_PING, FRAME_TEXT, HEADER, MAX_FRAME_SIZE, FrameDecoder, ProtocolError,
+                      encode_frame, encode_frames)
+
+os.environ.setdefault("STATE_BACKEND", "memory")   # server.py opens its backend on import
+import server  # noqa: E402
+
+def decoded(decoder):
+    return [(frame_type, bytes(payload)) for frame_type, payload in decoder.frames()]
+
+def test_partial_frame_waits_for_the_rest():
+    data = encode_frame(b"hello world")
+    decoder = FrameDecoder()
+    decoder.feed(data[:3])   # not even a whole header
+    assert decoded(decoder) == []
+    decoder.feed(data[3:8])
+    assert decoded(decoder) == []
+    decoder.feed(data[8:])
+    assert decoded(decoder) == [(FRAME_TEXT, b"hello world")]
+
+def test_several_frames_in_one_read():
+    decoder = FrameDecoder()
+    decoder.feed(encode_frames([b"one", b"two"]) + encode_frame(b"", FRAME_PING) + encode_frame(b"thr"))
+    assert decoded(decoder) == [(FRAME_TEXT, b"one"), (FRAME_TEXT, b"two"), (FRAME_PING, b""), (FRAME_TEXT, b"thr")]
+    assert (decoder.start, decoder.end) == (0, 0)   # fully parsed, buffer reused from the front
+
+def test_frame_split_across_reads_with_a_complete_one():
+    first, second = encode_frame(b"first"), encode_frame(b"second")
+    decoder = FrameDecoder()
+    decoder.feed(first + second[:4])
+    assert decoded(decoder) == [(FRAME_TEXT, b"first")]
+    decoder.feed(second[4:])
+    assert decoded(decoder) == [(FRAME_TEXT, b"second")]
+
+def test_buffer_grows_for_a_large_frame():
+    payload = b"x" * 100
+    decoder = FrameDecoder(size=16)
+    decoder.feed(encode_frame(payload))
+    assert decoded(decoder) == [(FRAME_TEXT, payload)]
+
+def test_oversized_frame_is_rejected():
+    decoder = FrameDecoder()
+    decoder.feed(HEADER.pack(MAX_FRAME_SIZE + 1, FRAME_TEXT))
+    with pytest.raises(ProtocolError):
+        decoded(decoder)
+
+def test_framed_magic_selects_framed_mode():
+    table = server.ClientTable(None, None, None)
+    table.start_wire("conn", FRAMED_MAGIC + encode_frames([b"LOGIN", b"alice", b"secret"]))
+    assert "conn" in table.decoders
+    assert list(table.inbox["conn"]) == ["LOGIN", "alice", "secret"]
+
+def test_other_first_bytes_fall_back_to_text_mode():
+    table = server.ClientTable(None, None, None)
+    table.start_wire("conn", "LOGIN\nalice\nsecret".encode())
+    assert "conn" not in table.decoders
+    assert list(table.inbox["conn"]) == ["LOGIN\nalice\nsecret"]
+
+def test_encode_outbound_keeps_text_lines_whole():
+    text, framed = server.encode_outbound("two\nlines")
+    assert text == b"two lines\n"
+    assert framed == encode_frame(b"two\nlines")
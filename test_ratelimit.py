@@ -0,0 +1,46 @@
+"""
+Tests for ratelimit.py's token buckets.
+
+    python -m pytest test_ratelimit.py
+"""
+import ratelimit
+from ratelimit import BucketTable, take_token
+
+def test_take_token_refills_with_time():
+    bucket = [2, 0.0]
+    assert take_token(bucket, 0.0, rate=1, burst=2)
+    assert take_token(bucket, 0.0, rate=1, burst=2)
+    assert not take_token(bucket, 0.5, rate=1, burst=2)   # half a token so far
+    assert take_token(bucket, 1.0, rate=1, burst=2)
+
+def test_take_token_never_exceeds_burst():
+    bucket = [0, 0.0]
+    assert take_token(bucket, 100.0, rate=1, burst=2)
+    assert bucket == [1, 100.0]
+
+def test_bucket_table_limits_each_key():
+    table = BucketTable(rate=0.001, burst=2)
+    assert [table.take("alice") for _ in range(3)] == [True, True, False]
+    assert table.take("bob")
+
+def test_zero_rate_disables_the_limit():
+    table = BucketTable(rate=0, burst=1)
+    assert all(table.take("alice") for _ in range(100))
+    assert table.buckets == {}
+
+def test_prune_forgets_full_buckets():
+    table = BucketTable(rate=1, burst=2)
+    table.take("alice")
+    table.take("bob")
+    table.take("bob")
+    table.prune(table.buckets["alice"][1] + 1)   # alice is full again by then, bob is not
+    assert list(table.buckets) == ["bob"]
+
+def test_take_prunes_after_the_interval(monkeypatch):
+    table = BucketTable(rate=1000, burst=1)
+    table.take("alice")
+    monkeypatch.setattr(ratelimit, "PRUNE_INTERVAL", 0)
+    table.pruned -= 1
+    table.buckets["alice"][1] -= 1   # refilled a second ago
+    table.take("bob")
+    assert list(table.buckets) == ["bob"]
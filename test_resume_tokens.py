@@ -0,0 +1,37 @@
+"""
+Tests for resume_tokens.py.
+
+    python -m pytest test_resume_tokens.py
+"""
+import pytest
+
+from resume_tokens import TokenError, find_token, issue_token, verify_token
+
+SECRET = b"s" * 32
+
+def test_issued_token_verifies():
+    token, token_id = issue_token(SECRET, "alice", ttl=60)
+    assert verify_token(SECRET, token) == ("alice", token_id)
+
+def test_expired_token_is_rejected():
+    token, _ = issue_token(SECRET, "alice", ttl=-1)
+    with pytest.raises(TokenError, match="expired"):
+        verify_token(SECRET, token)
+
+def test_bad_signature_is_rejected():
+    token, _ = issue_token(SECRET, "alice", ttl=60)
+    with pytest.raises(TokenError, match="signature"):
+        verify_token(b"another secret", token)
+    forged = token.replace("alice", "mallory", 1)
+    with pytest.raises(TokenError, match="signature"):
+        verify_token(SECRET, forged)
+
+def test_malformed_token_is_rejected():
+    for token in ("", "alice", "alice.soon.id.sig"):
+        with pytest.raises(TokenError, match="malformed"):
+            verify_token(SECRET, token)
+
+def test_find_token_in_a_glued_reply():
+    token, _ = issue_token(SECRET, "alice", ttl=60)
+    assert find_token(f"AUTH_SUCCESS {token}[SYSTEM] Joined room: lobby", "alice") == token
+    assert find_token(f"AUTH_SUCCESS {token}", "bob") is None
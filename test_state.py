@@ -0,0 +1,127 @@
+"""
+Tests for MemoryBackend (STATE_BACKEND=memory). No Redis or certificate needed.
+
+    python -m pytest test_state.py
+"""
+import asyncio
+import json
+import threading
+
+import state
+from state import MemoryBackend
+
+def published(backend):
+    """[(channel, decoded payload)] queued on the bus since the last call."""
+    messages = []
+    while not backend.bus.empty():
+        channel, payload = backend.bus.get()
+        messages.append((channel, json.loads(payload)))
+    return messages
+
+def test_join_switch_and_end_session():
+    backend = MemoryBackend(history_maxlen=10)
+    backend.register_session("alice", "lobby", None)
+    backend.enter_room("alice", "lobby", "alice joined lobby")
+    assert backend.session_holder("alice") == (True, None)
+    assert backend.rooms == {"lobby": {"alice"}}
+
+    assert backend.switch_room("alice", "games") == "lobby"
+    assert backend.rooms == {"games": {"alice"}}
+    assert [(channel, message["content"]) for channel, message in published(backend)] == [
+        ("room:lobby", "alice joined lobby"),
+        ("room:lobby", "alice left lobby"),
+        ("room:games", "alice joined games"),
+    ]
+
+    assert backend.end_session("alice", None, None) == "games"
+    assert backend.rooms == {}
+    assert backend.session_holder("alice") == (False, None)
+    assert [message["content"] for _, message in published(backend)] == ["alice left the chat"]
+    assert backend.end_session("alice", None, None) is None   # safe to run twice
+
+def test_end_session_keeps_room_for_current_resume_token():
+    backend = MemoryBackend(history_maxlen=10)
+    backend.register_session("alice", "lobby", None)
+    backend.switch_room("alice", "games")
+    backend.store_resume_token("alice", "token1", "lobby", ttl=60)
+    backend.end_session("alice", "token1", None)
+    assert backend.resume_record("alice") == ({"id": "token1", "room": "games"}, None)
+
+    backend.register_session("bob", "lobby", None)
+    backend.store_resume_token("bob", "token2", "lobby", ttl=60)
+    backend.end_session("bob", "revoked", None)
+    assert backend.resume_record("bob") == ({"id": "token2", "room": "lobby"}, None)
+
+def test_expired_resume_record_is_dropped():
+    backend = MemoryBackend(history_maxlen=10)
+    backend.store_resume_token("alice", "token1", "lobby", ttl=-1)
+    assert backend.resume_record("alice") == ({}, None)
+    assert "alice" not in backend.resume
+
+def test_rooms_page_lists_busiest_first():
+    backend = MemoryBackend(history_maxlen=10)
+    for username, room in [("a", "small"), ("b", "big"), ("c", "big"), ("d", "big"), ("e", "mid"), ("f", "mid")]:
+        backend.register_session(username, None, None)
+        backend.switch_room(username, room)
+    assert backend.rooms_page(0, 2) == ([("big", 3), ("mid", 2)], 3)
+    assert backend.rooms_page(2, 2) == ([("small", 1)], 3)
+
+    backend.end_session("a", None, None)   # empty rooms leave the index
+    assert backend.rooms_page(0, 10) == ([("big", 3), ("mid", 2)], 2)
+
+def test_room_history_replays_the_newest_payloads_in_order():
+    backend = MemoryBackend(history_maxlen=3)
+    for i in range(5):
+        assert backend.publish_room("lobby", "room:lobby", f"message {i}")
+    assert backend.room_history("lobby", 2) == ["message 3", "message 4"]
+    assert backend.room_history("lobby", 10) == ["message 2", "message 3", "message 4"]
+    assert backend.room_history("lobby", 0) == []
+    assert backend.room_history("empty", 10) == []
+
+def test_history_disabled_still_publishes():
+    backend = MemoryBackend(history_maxlen=0)
+    backend.publish_room("lobby", "room:lobby", "hello", "pub:alice")
+    assert backend.room_history("lobby", 10) == []
+    assert [backend.bus.get(), backend.bus.get()] == [("room:lobby", "hello"), ("pub:alice", "hello")]
+
+def test_room_rate_refuses_past_the_burst():
+    backend = MemoryBackend(history_maxlen=10)
+    results = [backend.publish_room("lobby", "room:lobby", "hi", room_rate=0.001, room_burst=2) for _ in range(3)]
+    assert results == [True, True, False]
+    assert backend.room_history("lobby", 10) == ["hi", "hi"]
+
+def test_ack_before_and_after_wait():
+    backend = MemoryBackend(history_maxlen=10)
+    backend.ack("early")   # the FORCE_LOGOUT can be acked before wait_ack starts
+    assert backend.wait_ack("early", 1)
+
+    waiter = threading.Thread(target=lambda: results.append(backend.wait_ack("waited", 5)))
+    results = []
+    waiter.start()
+    backend.ack("waited")
+    waiter.join()
+    assert results == [True]
+    assert backend.acks == {}
+
+def test_late_ack_expires(monkeypatch):
+    backend = MemoryBackend(history_maxlen=10)
+    assert not backend.wait_ack("late", 0.01)
+    monkeypatch.setattr(state, "ACK_TTL", -1)
+    backend.ack("late")   # its waiter gave up: kept only until the next ack
+    backend.ack("other")
+    assert list(backend.acks) == ["other"]
+
+def test_async_ack():
+    backend = MemoryBackend(history_maxlen=10)
+
+    async def scenario():
+        await backend.async_ack("early")
+        early = await backend.async_wait_ack("early", 1)
+        waiter = asyncio.ensure_future(backend.async_wait_ack("waited", 5))
+        await asyncio.sleep(0)
+        await backend.async_ack("waited")
+        timed_out = await backend.async_wait_ack("never", 0.01)
+        return early, await waiter, timed_out
+
+    assert asyncio.run(scenario()) == (True, True, False)
+    assert backend.async_acks == {}
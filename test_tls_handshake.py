@@ -0,0 +1,87 @@
+"""
+Tests for the TLS handshake limits of both engines: TLS_HANDSHAKE_TIMEOUT
+bounds the whole handshake, so clients that stall in it cannot keep the
+TLS_HANDSHAKE_CONCURRENCY slots from new connections.
+
+    python -m pytest test_tls_handshake.py
+"""
+import socket
+import ssl
+import threading
+import time
+import urllib.request
+
+import pytest
+
+from conftest import free_port
+
+HANDSHAKE_TIMEOUT = 1.0
+TRICKLE_DELAY = 0.2   # a ClientHello is a few hundred bytes: over a minute at this rate
+
+def client_hello():
+    """The first bytes a TLS client sends: its ClientHello."""
+    incoming, outgoing = ssl.MemoryBIO(), ssl.MemoryBIO()
+    tls = ssl.create_default_context().wrap_bio(incoming, outgoing, server_hostname="localhost")
+    try:
+        tls.do_handshake()
+    except ssl.SSLWantReadError:
+        pass
+    return outgoing.read()
+
+def trickle(port, hello, results):
+    """Sends hello one byte at a time and records the seconds until the
+    server hung up (or until giving up, well past the timeout)."""
+    started = time.monotonic()
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        try:
+            for byte in hello:
+                sock.sendall(bytes([byte]))
+                time.sleep(TRICKLE_DELAY)
+                if time.monotonic() - started > HANDSHAKE_TIMEOUT * 5:
+                    break
+        except OSError:
+            pass
+    results.append(time.monotonic() - started)
+
+def handshake_counts(metrics_port):
+    """chat_tls_handshakes_total by result."""
+    metrics = urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics").read().decode()
+    prefix = 'chat_tls_handshakes_total{result="'
+    return {line[len(prefix):].split('"')[0]: int(line.split()[-1])
+            for line in metrics.splitlines() if line.startswith(prefix)}
+
+@pytest.mark.parametrize("mode", ["threaded", "asyncio"])
+def test_trickling_clients_time_out_and_free_their_slots(start_server, cert_dir, mode):
+    metrics_port = free_port()
+    port = start_server(SERVER_MODE=mode, TLS_HANDSHAKE_TIMEOUT=str(HANDSHAKE_TIMEOUT),
+                        TLS_HANDSHAKE_CONCURRENCY="2", METRICS_PORT=str(metrics_port))
+    time.sleep(0.2)
+    before = handshake_counts(metrics_port)   # start_server's probe is one failed handshake
+    hello = client_hello()
+    cut_after = []
+    tricklers = [threading.Thread(target=trickle, args=(port, hello, cut_after)) for _ in range(2)]
+    for thread in tricklers:
+        thread.start()
+    time.sleep(0.3)   # both slots taken
+
+    # Waits for a slot, which the tricklers give up once their deadline passes
+    context = ssl.create_default_context(cafile=str(cert_dir / "server.crt"))
+    started = time.monotonic()
+    with socket.create_connection(("127.0.0.1", port), timeout=10) as raw:
+        with context.wrap_socket(raw, server_hostname="localhost"):
+            waited = time.monotonic() - started
+    for thread in tricklers:
+        thread.join()
+
+    assert max(cut_after) < HANDSHAKE_TIMEOUT * 3, cut_after
+    assert waited < HANDSHAKE_TIMEOUT * 3
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        sock.sendall(b"GET / HTTP/1.0\r\n\r\n")
+        try:
+            sock.recv(1)
+        except ConnectionResetError:
+            pass
+    time.sleep(0.2)
+    after = handshake_counts(metrics_port)
+    assert {result: after[result] - before.get(result, 0) for result in after} == \
+        {"full": 1, "timeout": 2, "failed": 1}